@@ -0,0 +1,270 @@
+"""
+Offline load test for the Santa graphs.
+
+Runs scripted conversations through the engine graph the way main.py does
+(sync, like the Streamlit app) and/or the way test.py does (async) against a
+local Postgres, with a fake chat model standing in for OpenAI. Reports per-turn
+latency percentiles, database statements per turn, checkpoint bytes written and
+throughput. Only the statements the conversations send are counted, not the
+ones from the rollup and the cache listener running in the background, and the
+checkpoint bytes are the ones the saver sent (see telemetry.checkpoint_bytes).
+
+    DB_URI=postgresql://postgres:@localhost:5432/postgres python bench.py --threads 20 --turns 5 --llm-latency 0.3
+"""
+
+import argparse
+import asyncio
+import contextvars
+import hashlib
+import json
+import os
+import re
+import statistics
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+# The graph modules create OpenAI clients, but never call them here
+os.environ.setdefault("OPENAI_API_KEY", "bench")
+
+import psycopg
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, HumanMessage, ToolMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+from langchain_core.runnables import RunnableLambda
+from langchain_core.utils.function_calling import convert_to_openai_tool
+
+import context
+import db
+import engine
+import ledger
+import nice_meter_cache
+import telemetry
+
+DB_URI = os.environ.get("DB_URI") or "postgresql://postgres:@localhost:5432/postgres?sslmode=disable"
+
+NAMES = ["John", "Emma", "Ola", "Nora", "Liam", "Sofie", "Noah", "Ella", "Jakob", "Maja"]
+DEEDS = [
+    "I vacuumed",
+    "I ate my veggies",
+    "I ate ice cream",
+    "I had a fight with a friend",
+    "I helped grandma carry her groceries",
+    "I said a bad word",
+    "That was a bad joke, santa",
+    "I walked the dog every day",
+]
+MESSAGE_PATTERN = re.compile(r"My name is (\w+)\. (.+)")
+
+class FakeSantaModel(BaseChatModel):
+    """
+    Deterministic stand-in for ChatOpenAI. A scripted message makes it call the
+    registration tool (or the check tool, if that is all it is bound to), a tool
+    result makes it answer, and structured output returns a nice_score for each
+    action, derived from the action.
+    """
+    latency: float = 0.0
+    tool_names: list[str] = []
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-santa"
+
+    def bind_tools(self, tools, **kwargs):
+        return self.model_copy(update={ "tool_names": [convert_to_openai_tool(tool)["function"]["name"] for tool in tools] })
+
+    def with_structured_output(self, schema, **kwargs):
+        return RunnableLambda(self._score, afunc=self._ascore)
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        time.sleep(self.latency)
+        return ChatResult(generations=[ChatGeneration(message=self._reply(messages))])
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        await asyncio.sleep(self.latency)
+        return ChatResult(generations=[ChatGeneration(message=self._reply(messages))])
+
+    def _reply(self, messages) -> AIMessage:
+        last = messages[-1]
+        if isinstance(last, ToolMessage):
+            return AIMessage(content=f"Ho-ho-ho! {last.content}")
+        match = MESSAGE_PATTERN.match(last.content) if isinstance(last, HumanMessage) else None
+        if match is None or not self.tool_names:
+            # Summaries and anything off script
+            return AIMessage(content="Ho-ho-ho, noted.")
+
+        name, action = match.groups()
+        if "register_naughty_or_nice" in self.tool_names:
+            tool_call = { "name": "register_naughty_or_nice", "args": { "name": name, "action": action } }
+        else:
+            tool_call = { "name": "check_naughty_list", "args": { "name": name } }
+        return AIMessage(content="", tool_calls=[{ **tool_call, "id": f"call_{uuid.uuid4().hex[:12]}" }])
+
+    def _score(self, prompt) -> dict:
+        time.sleep(self.latency)
+        return self._nice_score(prompt)
+
+    async def _ascore(self, prompt) -> dict:
+        await asyncio.sleep(self.latency)
+        return self._nice_score(prompt)
+
+    def _nice_score(self, prompt) -> dict:
+        # One "1. Name: action" line per deed
+        actions = [line.split(": ", 1)[-1] for line in prompt.to_messages()[-1].content.splitlines()]
+        return { "nice_scores": [int(hashlib.md5(action.encode()).hexdigest(), 16) % 21 - 10 for action in actions] }
+
+class StatementCounter:
+    """Counts the statements sent through psycopg inside `counting()`, in this process."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.count = 0
+        # Copied into the threads and tasks the graph starts, but not into the background rollup and listener
+        self.active = contextvars.ContextVar("counting_statements", default=False)
+
+    def counting(self):
+        self.active.set(True)
+
+    def install(self):
+        for cls in (psycopg.Cursor, psycopg.AsyncCursor):
+            for method in ("execute", "executemany"):
+                setattr(cls, method, self._wrap(getattr(cls, method)))
+
+    def _wrap(self, method):
+        counter = self
+        if asyncio.iscoroutinefunction(method):
+            async def wrapper(self, *args, **kwargs):
+                counter.add()
+                return await method(self, *args, **kwargs)
+        else:
+            def wrapper(self, *args, **kwargs):
+                counter.add()
+                return method(self, *args, **kwargs)
+        return wrapper
+
+    def add(self):
+        if not self.active.get():
+            return
+        with self.lock:
+            self.count += 1
+
+statements = StatementCounter()
+
+def script(conversation: int, turns: int) -> list[str]:
+    name = NAMES[conversation % len(NAMES)]
+    return [f"My name is {name}. {DEEDS[(conversation + turn) % len(DEEDS)]}" for turn in range(turns)]
+
+def fake_engine(language: str, latency: float) -> engine.Engine:
+    santa_engine = engine.get_engine(language)
+    llm = FakeSantaModel(latency=latency)
+    santa_engine.scoring_chain = santa_engine.scoring_prompt() | llm.with_structured_output({})
+    santa_engine.llm_with_tools = llm.bind_tools(santa_engine.tools)
+    context.summary_llm = llm
+    return santa_engine
+
+def run_main(args, prefix: str) -> list[float]:
+    import main
+
+    checkpointer = db.get_checkpointer(DB_URI, max_size=args.pool_size)
+    ledger.start_rollup()
+    nice_meter_cache.start_listener()
+    graph = fake_engine("en", args.llm_latency).compile(checkpointer)
+
+    def conversation(i: int) -> list[float]:
+        statements.counting()
+        latencies = []
+        for message in script(i, args.turns):
+            start = time.perf_counter()
+            for _ in main.transform_response_to_text(main.get_response(graph, message, f"{prefix}{i}")):
+                pass
+            latencies.append(time.perf_counter() - start)
+        return latencies
+
+    with ThreadPoolExecutor(max_workers=args.threads) as executor:
+        results = executor.map(conversation, range(args.conversations or args.threads))
+    return [latency for latencies in results for latency in latencies]
+
+async def run_test(args, prefix: str) -> list[float]:
+    checkpointer = await db.get_async_checkpointer(DB_URI, max_size=args.pool_size)
+    ledger.start_async_rollup()
+    nice_meter_cache.start_async_listener()
+    graph = fake_engine("no", args.llm_latency).compile(checkpointer)
+    semaphore = asyncio.Semaphore(args.threads)
+
+    async def conversation(i: int) -> list[float]:
+        statements.counting()
+        config = { "configurable": { "thread_id": f"{prefix}{i}" } }
+        latencies = []
+        async with semaphore:
+            for message in script(i, args.turns):
+                start = time.perf_counter()
+                async for _ in graph.astream({ "messages": [("user", message)] }, config, stream_mode="messages"):
+                    pass
+                latencies.append(time.perf_counter() - start)
+        return latencies
+
+    results = await asyncio.gather(*(conversation(i) for i in range(args.conversations or args.threads)))
+    return [latency for latencies in results for latency in latencies]
+
+def cleanup(prefix: str):
+    with psycopg.connect(DB_URI, autocommit=True) as conn:
+        for table in ("checkpoint_writes", "checkpoint_blobs", "checkpoints"):
+            conn.execute(f"DELETE FROM {table} WHERE thread_id LIKE %s", (prefix + "%",))
+
+def percentile(values: list[float], p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+def report(variant: str, latencies: list[float], elapsed: float, statement_count: int, written: int) -> dict:
+    turns = len(latencies)
+    result = {
+        "variant": variant,
+        "turns": turns,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "mean_ms": statistics.mean(latencies) * 1000,
+        "statements_per_turn": statement_count / turns,
+        "checkpoint_bytes_per_turn": written / turns,
+        "turns_per_second": turns / elapsed,
+    }
+    print(f"{variant:>5}: {turns} turns in {elapsed:.1f}s ({result['turns_per_second']:.1f}/s) | "
+          f"p50 {result['p50_ms']:.0f}ms p95 {result['p95_ms']:.0f}ms p99 {result['p99_ms']:.0f}ms | "
+          f"{result['statements_per_turn']:.1f} statements/turn | {result['checkpoint_bytes_per_turn']:.0f} checkpoint bytes/turn")
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Santa graphs with a fake LLM and a local Postgres.")
+    parser.add_argument("--variant", choices=["main", "test", "both"], default="both")
+    parser.add_argument("--threads", type=int, default=10, help="Conversations running at the same time")
+    parser.add_argument("--conversations", type=int, help="Conversations in total (default: same as --threads)")
+    parser.add_argument("--turns", type=int, default=5, help="Messages per conversation")
+    parser.add_argument("--llm-latency", type=float, default=0.0, help="Seconds each fake LLM call takes")
+    parser.add_argument("--pool-size", type=int, default=db.POOL_MAX_SIZE)
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    parser.add_argument("--keep", action="store_true", help="Keep the benchmark checkpoints instead of deleting them")
+    args = parser.parse_args()
+
+    statements.install()
+    results = []
+    for variant in (["main", "test"] if args.variant == "both" else [args.variant]):
+        prefix = f"bench-{variant}-{uuid.uuid4().hex[:8]}-"
+        before = statements.count
+        written = telemetry.checkpoint_bytes.value(direction="write")
+        start = time.perf_counter()
+        if variant == "main":
+            latencies = run_main(args, prefix)
+        else:
+            latencies = asyncio.run(run_test(args, prefix))
+        elapsed = time.perf_counter() - start
+        results.append(report(variant, latencies, elapsed, statements.count - before,
+                              telemetry.checkpoint_bytes.value(direction="write") - written))
+        if not args.keep:
+            cleanup(prefix)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""
+Bounded conversation context for the santa node.
+
+Only the last CONTEXT_KEEP_TURNS turns are sent to the LLM verbatim. Older
+turns are folded into a rolling summary kept in the graph state, so the prompt
+stops growing with the length of the thread. The summary is updated in batches
+of CONTEXT_SUMMARIZE_EVERY turns, so most turns skip the summarize node.
+
+The full message history stays in the state, so the chat can still be rendered.
+A turn starts with a human message, so a window that starts at a turn boundary
+always keeps tool calls and their results together.
+"""
+
+import os
+
+from langchain_core.messages import AIMessage, HumanMessage, ToolMessage
+from langchain_core.runnables import RunnableConfig, RunnableLambda
+
+from dispatcher import get_dispatcher
+
+CONTEXT_KEEP_TURNS = int(os.environ.get("CONTEXT_KEEP_TURNS", 6))
+CONTEXT_SUMMARIZE_EVERY = int(os.environ.get("CONTEXT_SUMMARIZE_EVERY", 4))
+CONTEXT_SUMMARY_MODEL = os.environ.get("CONTEXT_SUMMARY_MODEL", "gpt-4o-mini")
+
+summary_llm = None
+
+def get_summary_llm():
+    # Created on first use, so importing this module doesn't pull in langchain_openai
+    global summary_llm
+    if summary_llm is None:
+        from langchain_openai import ChatOpenAI
+        summary_llm = ChatOpenAI(model=CONTEXT_SUMMARY_MODEL, max_retries=0, stream_usage=True)
+    return summary_llm
+
+def window_start(messages: list, keep_turns: int = CONTEXT_KEEP_TURNS) -> int:
+    """Return the index of the first message in the last keep_turns turns."""
+    turns = [i for i, message in enumerate(messages) if isinstance(message, HumanMessage)]
+    if len(turns) <= keep_turns:
+        return 0
+    return turns[-keep_turns]
+
+def needs_summary(state: dict) -> bool:
+    messages = state["messages"]
+    unsummarized = messages[state.get("summarized", 0):window_start(messages)]
+    return sum(isinstance(message, HumanMessage) for message in unsummarized) >= CONTEXT_SUMMARIZE_EVERY
+
+def prompt_messages(system_prompt: str, summary_intro: str, state: dict) -> list:
+    """Build the prompt for the santa node: system prompt, rolling summary and the recent turns."""
+    messages = state["messages"]
+    prompt = [("system", system_prompt)]
+    if state.get("summary"):
+        prompt.append(("system", f"{summary_intro}\n{state['summary']}"))
+    # Turns between the summary and the window are still sent, until the next summary folds them in
+    return [*prompt, *messages[state.get("summarized", 0):]]
+
+def transcript(messages: list) -> str:
+    lines = []
+    for message in messages:
+        if isinstance(message, HumanMessage):
+            lines.append(f"Child: {message.content}")
+        elif isinstance(message, ToolMessage):
+            lines.append(f"List result: {message.content}")
+        elif isinstance(message, AIMessage):
+            for tool_call in message.tool_calls:
+                lines.append(f"Santa used {tool_call['name']} with {tool_call['args']}")
+            if message.content:
+                lines.append(f"Santa: {message.content}")
+    return "\n".join(lines)
+
+def make_summarize_node(summary_prompt: str) -> RunnableLambda:
+    """Create a graph node that folds the turns before the window into the rolling summary."""
+    def summary_input(state: dict) -> tuple[list, int] | None:
+        messages = state["messages"]
+        start = state.get("summarized", 0)
+        end = window_start(messages)
+        if end <= start:
+            return None
+        return [
+            ("system", summary_prompt),
+            ("human", f"{state.get('summary') or '-'}\n\n{transcript(messages[start:end])}")], end
+
+    def summarize(state: dict, config: RunnableConfig):
+        if (summary := summary_input(state)) is None:
+            return {}
+        prompt, end = summary
+        response = get_dispatcher(CONTEXT_SUMMARY_MODEL).invoke(get_summary_llm(), prompt, config)
+        return { "summary": response.content, "summarized": end }
+
+    async def asummarize(state: dict, config: RunnableConfig):
+        if (summary := summary_input(state)) is None:
+            return {}
+        prompt, end = summary
+        response = await get_dispatcher(CONTEXT_SUMMARY_MODEL).ainvoke(get_summary_llm(), prompt, config)
+        return { "summary": response.content, "summarized": end }
+
+    return RunnableLambda(summarize, afunc=asummarize, name="summarize")
+
+def route_context(state: dict) -> str:
+    return "summarize" if needs_summary(state) else "santa"
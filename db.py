@@ -0,0 +1,282 @@
+"""
+Process-wide Postgres pool and checkpointer, shared by all sessions and tools.
+The async variants (`get_async_checkpointer`, `async_cursor`) do the same for
+processes that run the graph on an event loop.
+
+The pool is created the first time `get_checkpointer` is called, and the
+migrations below are run once at that point instead of on every request.
+To add a new migration, add a new string to the MIGRATIONS list. The position
+of the migration in the list is the version number. A migration that needs
+Python is a (query, rewrite, update) tuple instead: rewrite turns the rows of
+query into parameters, and update runs once per parameter tuple. A list of
+migrations runs as one, and every migration runs in a transaction.
+"""
+
+import asyncio
+import atexit
+import json
+import os
+import threading
+from contextlib import asynccontextmanager, contextmanager
+
+from psycopg.rows import dict_row
+from psycopg_pool import AsyncConnectionPool, ConnectionPool
+from langgraph.checkpoint.postgres import PostgresSaver
+from langgraph.checkpoint.postgres.aio import AsyncPostgresSaver
+
+import telemetry
+
+
+def _renamed_names(rows) -> list[tuple[str, str]]:
+    """The (normalized, stored) pairs for the stored names that aren't normalized."""
+    # Imported here, since ledger imports this module
+    from ledger import normalize_name
+
+    return [(normalize_name(row["name"]), row["name"]) for row in rows if normalize_name(row["name"]) != row["name"]]
+
+MIGRATIONS = [
+    "CREATE TABLE IF NOT EXISTS naughty_nice_migrations (v INTEGER PRIMARY KEY)",
+    "CREATE TABLE IF NOT EXISTS naughty_nice (name TEXT PRIMARY KEY, nice_meter INT, updates INT DEFAULT 1)",
+    "CREATE INDEX IF NOT EXISTS naughty_nice_nice_meter_idx ON naughty_nice (nice_meter)",
+    "CREATE TABLE IF NOT EXISTS score_cache (key TEXT PRIMARY KEY, nice_score REAL NOT NULL, created_at TIMESTAMPTZ NOT NULL DEFAULT now())",
+    "CREATE INDEX IF NOT EXISTS score_cache_created_at_idx ON score_cache (created_at)",
+    "ALTER TABLE naughty_nice ALTER COLUMN nice_meter TYPE DOUBLE PRECISION",
+    """CREATE TABLE IF NOT EXISTS deed_ledger (
+    id BIGSERIAL PRIMARY KEY,
+    name TEXT NOT NULL,
+    action TEXT NOT NULL,
+    nice_score DOUBLE PRECISION NOT NULL,
+    deeds INT NOT NULL DEFAULT 1,
+    rolled_up BOOLEAN NOT NULL DEFAULT false,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+)""",
+    # Totals from before the ledger existed become one already rolled up row per name,
+    # so rebuilding from the ledger doesn't lose them
+    "INSERT INTO deed_ledger (name, action, nice_score, deeds, rolled_up) SELECT name, '', coalesce(nice_meter, 0), coalesce(updates, 1), true FROM naughty_nice",
+    "CREATE INDEX IF NOT EXISTS deed_ledger_pending_id_idx ON deed_ledger (id) WHERE NOT rolled_up",
+    "CREATE INDEX IF NOT EXISTS deed_ledger_pending_name_idx ON deed_ledger (name) WHERE NOT rolled_up",
+    # Names are stored normalized from now on (see ledger.normalize_name), so existing names
+    # are normalized too, and the totals of names that now are the same are merged.
+    # The names are normalized in Python, so they match what ledger stores exactly.
+    # One transaction, with the tables locked like ledger.rebuild does, so nobody reads
+    # the totals half rebuilt and no rollup runs in between
+    [
+        "LOCK TABLE deed_ledger, naughty_nice IN EXCLUSIVE MODE",
+        ("SELECT DISTINCT name FROM deed_ledger", _renamed_names, "UPDATE deed_ledger SET name = %s WHERE name = %s"),
+        "DELETE FROM naughty_nice",
+        "INSERT INTO naughty_nice (name, nice_meter, updates) SELECT name, sum(nice_score), sum(deeds) FROM deed_ledger WHERE rolled_up GROUP BY name",
+    ],
+]
+
+POOL_MIN_SIZE = int(os.environ.get("DB_POOL_MIN_SIZE", 1))
+POOL_MAX_SIZE = int(os.environ.get("DB_POOL_MAX_SIZE", 10))
+POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", 10))
+POOL_MAX_IDLE = float(os.environ.get("DB_POOL_MAX_IDLE", 300))
+
+_lock = threading.Lock()
+_pool: ConnectionPool | None = None
+_checkpointer: PostgresSaver | None = None
+
+_async_lock = asyncio.Lock()
+_async_pool: AsyncConnectionPool | None = None
+_async_checkpointer: AsyncPostgresSaver | None = None
+
+CONNECTION_KWARGS = { "autocommit": True, "prepare_threshold": 0, "row_factory": dict_row }
+# Every statement is timed, see telemetry.py
+SYNC_CONNECTION_KWARGS = { **CONNECTION_KWARGS, "cursor_factory": telemetry.TimedCursor }
+ASYNC_CONNECTION_KWARGS = { **CONNECTION_KWARGS, "cursor_factory": telemetry.AsyncTimedCursor }
+
+def _blob_bytes(rows, index: int) -> int:
+    return sum(len(row[index] or b"") for row in rows or [])
+
+class MeasuredCheckpoints:
+    """
+    Counts the checkpoint bytes a Postgres saver sends and receives: the checkpoint
+    JSON, the metadata, the channel blobs and the pending writes. It hooks the
+    methods that put, put_writes, get_tuple and list turn rows into values with,
+    so the sync and async savers share it.
+    """
+    def _dump_checkpoint(self, checkpoint):
+        dumped = super()._dump_checkpoint(checkpoint)
+        # Sent as Jsonb, which psycopg dumps with json.dumps
+        telemetry.checkpoint_bytes.inc(len(json.dumps(dumped)), direction="write")
+        return dumped
+
+    def _load_checkpoint(self, checkpoint, channel_values, pending_sends):
+        size = len(json.dumps(checkpoint)) + _blob_bytes(channel_values, 2) + _blob_bytes(pending_sends, 1)
+        telemetry.checkpoint_bytes.inc(size, direction="read")
+        return super()._load_checkpoint(checkpoint, channel_values, pending_sends)
+
+    def _dump_blobs(self, thread_id, checkpoint_ns, values, versions):
+        rows = super()._dump_blobs(thread_id, checkpoint_ns, values, versions)
+        telemetry.checkpoint_bytes.inc(_blob_bytes(rows, -1), direction="write")
+        return rows
+
+    def _dump_writes(self, thread_id, checkpoint_ns, checkpoint_id, task_id, writes):
+        rows = super()._dump_writes(thread_id, checkpoint_ns, checkpoint_id, task_id, writes)
+        telemetry.checkpoint_bytes.inc(_blob_bytes(rows, -1), direction="write")
+        return rows
+
+    def _load_writes(self, writes):
+        telemetry.checkpoint_bytes.inc(_blob_bytes(writes, 3), direction="read")
+        return super()._load_writes(writes)
+
+    def _dump_metadata(self, metadata):
+        dumped = super()._dump_metadata(metadata)
+        telemetry.checkpoint_bytes.inc(len(dumped.encode()), direction="write")
+        return dumped
+
+    def _load_metadata(self, metadata):
+        # Same round trip as the base class, sized on the way
+        data = self.jsonplus_serde.dumps(metadata)
+        telemetry.checkpoint_bytes.inc(len(data), direction="read")
+        return self.jsonplus_serde.loads(data)
+
+class MeasuredPostgresSaver(MeasuredCheckpoints, PostgresSaver):
+    pass
+
+class MeasuredAsyncPostgresSaver(MeasuredCheckpoints, AsyncPostgresSaver):
+    pass
+
+def get_checkpointer(conn_string: str, min_size: int = POOL_MIN_SIZE, max_size: int = POOL_MAX_SIZE,
+                     timeout: float = POOL_TIMEOUT, max_idle: float = POOL_MAX_IDLE) -> PostgresSaver:
+    """Return the shared checkpointer, creating the pool and running migrations on first use."""
+    global _pool, _checkpointer
+    with _lock:
+        if _checkpointer is None:
+            _pool = ConnectionPool(
+                conn_string,
+                min_size=min_size,
+                max_size=max_size,
+                timeout=timeout,
+                max_idle=max_idle,
+                kwargs=SYNC_CONNECTION_KWARGS,
+                open=True)
+            try:
+                checkpointer = MeasuredPostgresSaver(_pool)
+                checkpointer.setup()
+                migrate()
+            except Exception:
+                # Otherwise every retry would open another pool and leave this one open
+                _pool.close()
+                _pool = None
+                raise
+            atexit.register(_pool.close)
+            _checkpointer = checkpointer
+    return _checkpointer
+
+def get_pool() -> ConnectionPool:
+    if _pool is None:
+        raise RuntimeError("The database pool has not been created, call get_checkpointer first")
+    return _pool
+
+@contextmanager
+def cursor():
+    """Borrow a connection from the pool and yield a dict-row cursor on it."""
+    with get_pool().connection() as conn:
+        with conn.cursor() as cur:
+            yield cur
+
+async def get_async_checkpointer(conn_string: str, min_size: int = POOL_MIN_SIZE, max_size: int = POOL_MAX_SIZE,
+                                 timeout: float = POOL_TIMEOUT, max_idle: float = POOL_MAX_IDLE) -> AsyncPostgresSaver:
+    """Async version of get_checkpointer, backed by an AsyncConnectionPool."""
+    global _async_pool, _async_checkpointer
+    async with _async_lock:
+        if _async_checkpointer is None:
+            _async_pool = AsyncConnectionPool(
+                conn_string,
+                min_size=min_size,
+                max_size=max_size,
+                timeout=timeout,
+                max_idle=max_idle,
+                kwargs=ASYNC_CONNECTION_KWARGS,
+                open=False)
+            try:
+                await _async_pool.open()
+                checkpointer = MeasuredAsyncPostgresSaver(_async_pool)
+                await checkpointer.setup()
+                await amigrate()
+            except Exception:
+                await _async_pool.close()
+                _async_pool = None
+                raise
+            _async_checkpointer = checkpointer
+    return _async_checkpointer
+
+def get_async_pool() -> AsyncConnectionPool:
+    if _async_pool is None:
+        raise RuntimeError("The async database pool has not been created, call get_async_checkpointer first")
+    return _async_pool
+
+@asynccontextmanager
+async def async_cursor():
+    async with get_async_pool().connection() as conn:
+        async with conn.cursor() as cur:
+            yield cur
+
+# Replicas starting at the same time must not run the same migration twice
+MIGRATIONS_LOCK = "SELECT pg_advisory_lock(hashtext('naughty_nice_migrations'))"
+MIGRATIONS_UNLOCK = "SELECT pg_advisory_unlock(hashtext('naughty_nice_migrations'))"
+MIGRATIONS_VERSION = "SELECT v FROM naughty_nice_migrations ORDER BY v DESC LIMIT 1"
+MIGRATIONS_INSERT = "INSERT INTO naughty_nice_migrations (v) VALUES (%s)"
+
+def _pending_migrations(row) -> range:
+    version = -1 if row is None else row["v"]
+    return range(version + 1, len(MIGRATIONS))
+
+def _run_migration(cur, migration):
+    if isinstance(migration, str):
+        cur.execute(migration)
+        return
+    if isinstance(migration, list):
+        for step in migration:
+            _run_migration(cur, step)
+        return
+    query, rewrite, update = migration
+    params = rewrite(cur.execute(query).fetchall())
+    if params:
+        cur.executemany(update, params)
+
+async def _arun_migration(cur, migration):
+    if isinstance(migration, str):
+        await cur.execute(migration)
+        return
+    if isinstance(migration, list):
+        for step in migration:
+            await _arun_migration(cur, step)
+        return
+    query, rewrite, update = migration
+    await cur.execute(query)
+    params = rewrite(await cur.fetchall())
+    if params:
+        await cur.executemany(update, params)
+
+def migrate():
+    with cursor() as cur:
+        cur.execute(MIGRATIONS_LOCK)
+        try:
+            cur.execute(MIGRATIONS[0])
+            row = cur.execute(MIGRATIONS_VERSION).fetchone()
+            for v in _pending_migrations(row):
+                print("Running migration: ", v)
+                # A migration and its version commit together, so a crash can't half apply it or apply it twice
+                with cur.connection.transaction():
+                    _run_migration(cur, MIGRATIONS[v])
+                    cur.execute(MIGRATIONS_INSERT, (v,))
+        finally:
+            cur.execute(MIGRATIONS_UNLOCK)
+
+async def amigrate():
+    async with async_cursor() as cur:
+        await cur.execute(MIGRATIONS_LOCK)
+        try:
+            await cur.execute(MIGRATIONS[0])
+            await cur.execute(MIGRATIONS_VERSION)
+            row = await cur.fetchone()
+            for v in _pending_migrations(row):
+                print("Running migration: ", v)
+                async with cur.connection.transaction():
+                    await _arun_migration(cur, MIGRATIONS[v])
+                    await cur.execute(MIGRATIONS_INSERT, (v,))
+        finally:
+            await cur.execute(MIGRATIONS_UNLOCK)
@@ -0,0 +1,203 @@
+"""
+Shared dispatch layer for LLM calls, one Dispatcher per model per process.
+
+Every call to a model goes through its dispatcher, which:
+
+- caps the number of calls in flight (LLM_MAX_CONCURRENCY)
+- spaces calls out with a token bucket (LLM_REQUESTS_PER_SECOND, bursts of LLM_BURST)
+- retries rate limits (429), server errors (5xx) and connection errors up to
+  LLM_MAX_RETRIES times, with full jitter backoff, or after Retry-After if the API sent one
+- lets identical calls share one request while it is in flight, when the caller
+  passes a `key`
+
+Limits can be set per model with LLM_LIMITS, for example
+LLM_LIMITS='{"gpt-4o": {"max_concurrency": 8, "requests_per_second": 5}}'.
+The ChatOpenAI clients are created with max_retries=0, so retries only happen here.
+"""
+
+import asyncio
+import json
+import os
+import random
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Hashable
+
+from langchain_core.runnables import Runnable, RunnableConfig
+
+import telemetry
+
+LLM_MAX_CONCURRENCY = int(os.environ.get("LLM_MAX_CONCURRENCY", 16))
+LLM_REQUESTS_PER_SECOND = float(os.environ.get("LLM_REQUESTS_PER_SECOND", 20))
+LLM_BURST = int(os.environ.get("LLM_BURST", 20))
+LLM_MAX_RETRIES = int(os.environ.get("LLM_MAX_RETRIES", 4))
+LLM_LIMITS = json.loads(os.environ.get("LLM_LIMITS") or "{}")
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 20
+
+class TokenBucket:
+    """Allows `rate` calls per second on average, and bursts of up to `burst` calls."""
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """Take a token, and return how many seconds to wait before using it."""
+        if self.rate <= 0:
+            return 0
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # Tokens can go negative, which queues the callers up behind each other
+            self.tokens -= 1
+            return 0 if self.tokens >= 0 else -self.tokens / self.rate
+
+def retry_delay(error: Exception, attempt: int) -> float | None:
+    """Return how long to wait before retrying after `error`, or None if it shouldn't be retried."""
+    import openai
+
+    if isinstance(error, openai.APIStatusError):
+        if error.status_code != 429 and error.status_code < 500:
+            return None
+        retry_after = error.response.headers.get("retry-after")
+        if retry_after is not None:
+            try:
+                return min(float(retry_after), BACKOFF_MAX)
+            except ValueError:
+                pass
+    elif not isinstance(error, (openai.APIConnectionError, ConnectionError, TimeoutError)):
+        return None
+    # Full jitter, so callers that failed together don't retry together
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+def _reason(error: Exception) -> str:
+    return str(getattr(error, "status_code", None) or type(error).__name__)
+
+class Dispatcher:
+    def __init__(self, model: str, max_concurrency: int = LLM_MAX_CONCURRENCY,
+                 requests_per_second: float = LLM_REQUESTS_PER_SECOND, burst: int = LLM_BURST,
+                 max_retries: int = LLM_MAX_RETRIES):
+        self.model = model
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.bucket = TokenBucket(requests_per_second, burst)
+        self.slots = threading.BoundedSemaphore(max_concurrency)
+        # Created on first use, on the event loop that uses it
+        self.async_slots: asyncio.Semaphore | None = None
+        self.lock = threading.Lock()
+        self.in_flight: dict[Hashable, Future] = {}
+        self.async_in_flight: dict[Hashable, asyncio.Task] = {}
+
+    def invoke(self, runnable: Runnable, input: Any, config: RunnableConfig | None = None, key: Hashable | None = None):
+        """Call runnable.invoke(input, config) within the limits. Calls with the same key share one request."""
+        if key is None:
+            return self._invoke(runnable, input, config)
+
+        with self.lock:
+            future = self.in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = self.in_flight[key] = Future()
+        if not leader:
+            telemetry.llm_coalesced.inc(model=self.model)
+            return future.result()
+
+        try:
+            result = self._invoke(runnable, input, config)
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+
+    async def ainvoke(self, runnable: Runnable, input: Any, config: RunnableConfig | None = None, key: Hashable | None = None):
+        if key is None:
+            return await self._ainvoke(runnable, input, config)
+
+        # Only the event loop touches async_in_flight, so it needs no lock
+        task = self.async_in_flight.get(key)
+        if task is not None:
+            telemetry.llm_coalesced.inc(model=self.model)
+        else:
+            # The call runs in its own task, so cancelling one caller doesn't cancel the others
+            task = self.async_in_flight[key] = asyncio.ensure_future(self._ainvoke(runnable, input, config))
+            task.add_done_callback(lambda done: self._acall_done(key, done))
+        return await asyncio.shield(task)
+
+    def _acall_done(self, key: Hashable, task: asyncio.Task):
+        if self.async_in_flight.get(key) is task:
+            del self.async_in_flight[key]
+        # Every caller may be gone, and an unretrieved exception is logged when the task is collected
+        if not task.cancelled():
+            task.exception()
+
+    def _invoke(self, runnable: Runnable, input: Any, config: RunnableConfig | None):
+        for attempt in range(self.max_retries + 1):
+            queued = time.perf_counter()
+            telemetry.llm_queue_depth.inc(model=self.model)
+            try:
+                self.slots.acquire()
+            finally:
+                telemetry.llm_queue_depth.dec(model=self.model)
+            try:
+                time.sleep(self.bucket.reserve())
+                telemetry.llm_wait_seconds.observe(time.perf_counter() - queued, model=self.model)
+                telemetry.llm_in_flight.inc(model=self.model)
+                try:
+                    return runnable.invoke(input, config)
+                finally:
+                    telemetry.llm_in_flight.dec(model=self.model)
+            except Exception as e:
+                delay = retry_delay(e, attempt)
+                if delay is None or attempt == self.max_retries:
+                    raise
+                telemetry.llm_retries.inc(model=self.model, reason=_reason(e))
+            finally:
+                self.slots.release()
+            # Sleep without holding a slot, so other calls can use it meanwhile
+            time.sleep(delay)
+
+    async def _ainvoke(self, runnable: Runnable, input: Any, config: RunnableConfig | None):
+        if self.async_slots is None:
+            self.async_slots = asyncio.Semaphore(self.max_concurrency)
+        for attempt in range(self.max_retries + 1):
+            queued = time.perf_counter()
+            telemetry.llm_queue_depth.inc(model=self.model)
+            try:
+                await self.async_slots.acquire()
+            finally:
+                telemetry.llm_queue_depth.dec(model=self.model)
+            try:
+                await asyncio.sleep(self.bucket.reserve())
+                telemetry.llm_wait_seconds.observe(time.perf_counter() - queued, model=self.model)
+                telemetry.llm_in_flight.inc(model=self.model)
+                try:
+                    return await runnable.ainvoke(input, config)
+                finally:
+                    telemetry.llm_in_flight.dec(model=self.model)
+            except Exception as e:
+                delay = retry_delay(e, attempt)
+                if delay is None or attempt == self.max_retries:
+                    raise
+                telemetry.llm_retries.inc(model=self.model, reason=_reason(e))
+            finally:
+                self.async_slots.release()
+            await asyncio.sleep(delay)
+
+_dispatchers: dict[str, Dispatcher] = {}
+_dispatchers_lock = threading.Lock()
+
+def get_dispatcher(model: str) -> Dispatcher:
+    """Return the dispatcher for a model, shared by every session in the process."""
+    with _dispatchers_lock:
+        if model not in _dispatchers:
+            _dispatchers[model] = Dispatcher(model, **LLM_LIMITS.get(model, {}))
+        return _dispatchers[model]
@@ -0,0 +1,308 @@
+"""
+The Santa conversation engine, shared by the Streamlit app (main.py) and the
+terminal app (test.py).
+
+There is one Engine per prompt pack (see prompts.py). It holds the graph
+builder, the tools and the LLM clients for that language. Every tool and node
+has a sync and an async version, so the same graph runs with `stream` in
+Streamlit and with `astream` on an event loop.
+
+`replay` runs a JSONL file of scripted conversations through a graph, many at
+a time, for regression checks and for warming up the score cache:
+
+    {"messages": ["Hi, I'm Ola", "I vacuumed"]}
+    {"thread_id": "regression-2", "messages": ["My name is Nora. I ate my veggies"]}
+"""
+
+import asyncio
+import json
+import threading
+import time
+import uuid
+from typing import Annotated
+
+from typing_extensions import TypedDict
+from langchain_core.messages import AIMessage, HumanMessage
+from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.runnables import RunnableConfig, RunnableLambda
+from langchain_core.tools import StructuredTool
+from langgraph.graph import START, StateGraph
+from langgraph.graph.message import add_messages
+from langgraph.prebuilt import ToolNode, tools_condition
+
+import ledger
+import telemetry
+from dispatcher import get_dispatcher
+from context import make_summarize_node, prompt_messages, route_context
+from prompts import PACKS, PromptPack
+from score_cache import ScoreCache, normalize_action
+
+CHAT_MODEL = "gpt-4o"
+
+SCORING_SCHEMA = {
+    "title": "scores",
+    "description": "The scores of the users actions",
+    "type": "object",
+    "properties": {
+        "nice_scores": {
+            "title": "Nice scores",
+            "description": "The score of each action, in the same order as the actions",
+            "type": "array",
+            "items": { "type": "number" }
+        }
+    }
+}
+
+class State(TypedDict):
+    messages: Annotated[list, add_messages]
+    # Rolling summary of the messages before index `summarized`, see context.py
+    summary: str
+    summarized: int
+
+class Deed(TypedDict):
+    name: str
+    action: str
+
+class Engine:
+    def __init__(self, pack: PromptPack):
+        self.pack = pack
+        self.score_cache = ScoreCache(pack.language)
+        # The LLM clients are created on first use, so importing this module doesn't pull in langchain_openai
+        self.scoring_chain = None
+        self.llm_with_tools = None
+
+        # The sync method gives each tool its name, arguments and description
+        self.tools = [
+            StructuredTool.from_function(self.check_naughty_list, self.acheck_naughty_list),
+            StructuredTool.from_function(self.register_naughty_or_nice, self.aregister_naughty_or_nice),
+            StructuredTool.from_function(self.register_deeds, self.aregister_deeds),
+        ]
+
+        self.graph_builder = StateGraph(State)
+
+        # Add nodes
+        self.graph_builder.add_node("santa", RunnableLambda(self._santa, afunc=self._asanta, name="santa"))
+        self.graph_builder.add_node("tools", ToolNode(self.tools))
+        self.graph_builder.add_node("summarize", make_summarize_node(pack.summary_prompt))
+
+        # Add edges
+        self.graph_builder.add_conditional_edges(START, route_context)
+        self.graph_builder.add_edge("summarize", "santa")
+        self.graph_builder.add_conditional_edges("santa", tools_condition)
+        self.graph_builder.add_edge("tools", "santa")
+
+    def compile(self, checkpointer):
+        return self.graph_builder.compile(checkpointer=checkpointer)
+
+    ### LLM clients ###
+
+    def scoring_prompt(self) -> ChatPromptTemplate:
+        examples = []
+        for actions, scores in self.pack.scoring_examples:
+            examples.append(HumanMessage(actions, name="example_user"))
+            examples.append(AIMessage(scores, name="example_system"))
+
+        return ChatPromptTemplate.from_messages([
+            ("system", self.pack.scoring_prompt),
+            ("placeholder", "{examples}"),
+            ("human", "{input}")]).partial(examples=examples)
+
+    def get_scoring_chain(self):
+        if self.scoring_chain is None:
+            from langchain_openai import ChatOpenAI
+            self.scoring_chain = self.scoring_prompt() | ChatOpenAI(model=CHAT_MODEL, max_retries=0, stream_usage=True).with_structured_output(SCORING_SCHEMA)
+        return self.scoring_chain
+
+    def get_llm_with_tools(self):
+        if self.llm_with_tools is None:
+            from langchain_openai import ChatOpenAI
+            # The calls are streamed, and a streamed call only reports its token usage with stream_usage
+            self.llm_with_tools = ChatOpenAI(model=CHAT_MODEL, max_retries=0, stream_usage=True).bind_tools(self.tools)
+        return self.llm_with_tools
+
+    ### Nodes ###
+
+    def _prompt(self, state: State) -> list:
+        return prompt_messages(self.pack.system_prompt, self.pack.summary_intro, state)
+
+    def _santa(self, state: State, config: RunnableConfig):
+        response = get_dispatcher(CHAT_MODEL).invoke(self.get_llm_with_tools(), self._prompt(state), config)
+        return { "messages": [response]}
+
+    async def _asanta(self, state: State, config: RunnableConfig):
+        response = await get_dispatcher(CHAT_MODEL).ainvoke(self.get_llm_with_tools(), self._prompt(state), config)
+        return { "messages": [response]}
+
+    ### Tools ###
+
+    def describe_standing(self, name: str, nice_meter: float) -> str:
+        template = self.pack.nice if float(nice_meter) > 0 else self.pack.naughty
+        # The name as it is stored and shown in the top scores, not as the child wrote it
+        return template.format(name=ledger.normalize_name(name), nice_meter=float(nice_meter))
+
+    def _describe_nice_meter(self, name: str, nice_meter: float | None) -> str:
+        if nice_meter is None:
+            return self.pack.no_deeds
+        return self.describe_standing(name, nice_meter)
+
+    def _describe_registered(self, deeds: list[Deed], nice_meters: dict[str, float]) -> str:
+        standings = " ".join(self.describe_standing(name, nice_meter) for name, nice_meter in nice_meters.items())
+        return self.pack.registered_many.format(count=len(deeds), standings=standings)
+
+    def check_naughty_list(self, name: str, config: RunnableConfig):
+        """Call with a name, to check if the name is on the naughty list."""
+        try:
+            return self._describe_nice_meter(name, ledger.get_nice_meter(name))
+        except Exception as e:
+            print("Error: ", e)
+            return self.pack.read_error
+
+    async def acheck_naughty_list(self, name: str, config: RunnableConfig):
+        try:
+            return self._describe_nice_meter(name, await ledger.aget_nice_meter(name))
+        except Exception as e:
+            print("Error: ", e)
+            return self.pack.read_error
+
+    def _score_input(self, deeds: list[Deed]) -> dict:
+        return { "input": "\n".join(f"{i}. {deed['name']}: {deed['action']}" for i, deed in enumerate(deeds, 1)) }
+
+    def _score_key(self, deeds: list[Deed]) -> tuple:
+        # Scores don't depend on the name, same as in the score cache
+        return (self.pack.language, *(normalize_action(deed["action"]) for deed in deeds))
+
+    def _nice_scores(self, deeds: list[Deed], chain_res: dict) -> list[float]:
+        nice_scores = [float(nice_score) for nice_score in chain_res["nice_scores"]]
+        if len(nice_scores) != len(deeds):
+            raise ValueError(f"Got {len(nice_scores)} scores for {len(deeds)} actions")
+        return nice_scores
+
+    def score_deeds(self, deeds: list[Deed], config: RunnableConfig) -> list[float]:
+        """Look the deeds up in the score cache, and score the rest with one LLM call."""
+        nice_scores = [self.score_cache.get(deed["action"]) for deed in deeds]
+        unscored = [i for i, nice_score in enumerate(nice_scores) if nice_score is None]
+        if unscored:
+            unscored_deeds = [deeds[i] for i in unscored]
+            # Kids tattling on the same thing at the same time share one scoring request
+            chain_res = get_dispatcher(CHAT_MODEL).invoke(self.get_scoring_chain(), self._score_input(unscored_deeds), config,
+                                                          key=self._score_key(unscored_deeds))
+            for i, nice_score in zip(unscored, self._nice_scores(unscored_deeds, chain_res)):
+                nice_scores[i] = nice_score
+                self.score_cache.put(deeds[i]["action"], nice_score)
+        return nice_scores
+
+    async def ascore_deeds(self, deeds: list[Deed], config: RunnableConfig) -> list[float]:
+        nice_scores = [await self.score_cache.aget(deed["action"]) for deed in deeds]
+        unscored = [i for i, nice_score in enumerate(nice_scores) if nice_score is None]
+        if unscored:
+            unscored_deeds = [deeds[i] for i in unscored]
+            chain_res = await get_dispatcher(CHAT_MODEL).ainvoke(self.get_scoring_chain(), self._score_input(unscored_deeds), config,
+                                                                 key=self._score_key(unscored_deeds))
+            for i, nice_score in zip(unscored, self._nice_scores(unscored_deeds, chain_res)):
+                nice_scores[i] = nice_score
+                await self.score_cache.aput(deeds[i]["action"], nice_score)
+        return nice_scores
+
+    def register_naughty_or_nice(self, name: str, action: str, config: RunnableConfig):
+        """Call with a name and action, to update the naughty or nice score for the name. Returns whether the name is now on the nice or naughty list."""
+        [nice_score] = self.score_deeds([{ "name": name, "action": action }], config)
+
+        try:
+            # The deed goes to the ledger, and the rollup adds it to the total for the name
+            nice_meter = ledger.append(name, action, nice_score)
+        except Exception as e:
+            print("Error: ", e)
+            raise e
+
+        # Return the new standing, so Santa doesn't need another turn to check the list
+        return self.pack.registered.format(standing=self.describe_standing(name, nice_meter))
+
+    async def aregister_naughty_or_nice(self, name: str, action: str, config: RunnableConfig):
+        [nice_score] = await self.ascore_deeds([{ "name": name, "action": action }], config)
+
+        try:
+            nice_meter = await ledger.aappend(name, action, nice_score)
+        except Exception as e:
+            print("Error: ", e)
+            raise e
+
+        return self.pack.registered.format(standing=self.describe_standing(name, nice_meter))
+
+    def register_deeds(self, deeds: list[Deed], config: RunnableConfig):
+        """Call with a list of names and actions, to register several deeds at once, for example when a child tells on their friends. Returns whether each name is now on the nice or naughty list."""
+        if not deeds:
+            return self.pack.nothing_to_register
+        nice_scores = self.score_deeds(deeds, config)
+
+        try:
+            nice_meters = ledger.append_many([(deed["name"], deed["action"], nice_score) for deed, nice_score in zip(deeds, nice_scores)])
+        except Exception as e:
+            print("Error: ", e)
+            raise e
+
+        return self._describe_registered(deeds, nice_meters)
+
+    async def aregister_deeds(self, deeds: list[Deed], config: RunnableConfig):
+        if not deeds:
+            return self.pack.nothing_to_register
+        nice_scores = await self.ascore_deeds(deeds, config)
+
+        try:
+            nice_meters = await ledger.aappend_many([(deed["name"], deed["action"], nice_score) for deed, nice_score in zip(deeds, nice_scores)])
+        except Exception as e:
+            print("Error: ", e)
+            raise e
+
+        return self._describe_registered(deeds, nice_meters)
+
+_engines: dict[str, Engine] = {}
+_engines_lock = threading.Lock()
+
+def get_engine(language: str) -> Engine:
+    """Return the engine for a language in PACKS, creating it on first use. One per process."""
+    with _engines_lock:
+        if language not in _engines:
+            _engines[language] = Engine(PACKS[language])
+        return _engines[language]
+
+### Replay ###
+
+async def run_conversation(graph, thread_id: str, messages: list[str]) -> tuple[list[str], list[float]]:
+    """Send the messages to Santa one by one in a thread, and return his replies and how long each took."""
+    config = { "configurable": { "thread_id": thread_id }, "callbacks": [telemetry.callback_handler] }
+    replies = []
+    seconds = []
+    for message in messages:
+        reply = ""
+        start = time.perf_counter()
+        with telemetry.trace("santa", thread_id=thread_id):
+            async for msg, metadata in graph.astream({"messages": [("user", message)]}, config, stream_mode="messages"):
+                if msg.content and metadata["langgraph_node"] == "santa":
+                    reply += msg.content
+        seconds.append(time.perf_counter() - start)
+        replies.append(reply)
+    return replies, seconds
+
+async def replay(graph, conversations: list[dict], concurrency: int, output=None) -> list[dict]:
+    """
+    Run many conversations at once on the event loop, at most `concurrency` at a time.
+    Writes a JSON line per conversation to `output` (a file, or stdout if None) as they finish,
+    and returns the results.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    results = []
+
+    async def run_one(conversation: dict):
+        thread_id = conversation.get("thread_id") or str(uuid.uuid4())
+        result = { "thread_id": thread_id, "messages": conversation["messages"] }
+        async with semaphore:
+            try:
+                result["replies"], result["seconds"] = await run_conversation(graph, thread_id, conversation["messages"])
+            except Exception as e:
+                print("Error: ", e)
+                result["error"] = str(e)
+        results.append(result)
+        print(json.dumps(result, ensure_ascii=False), file=output, flush=True)
+
+    await asyncio.gather(*(run_one(conversation) for conversation in conversations))
+    return results
@@ -0,0 +1,154 @@
+"""
+A local stand-in for the OpenAI chat completions API, for testing the LLM
+dispatcher and the apps under load without calling OpenAI.
+
+It answers like bench.FakeSantaModel does. "My name is Ola. I vacuumed"
+makes it call register_naughty_or_nice, a tool result makes it answer, and a
+forced function call (structured output) returns a score per numbered action.
+A share of the requests fail with 429 or 500. GET /stats returns request
+counts and the highest number of requests in flight at once.
+
+    python fake_openai.py --port 8001 --latency 0.3 --error-rate 0.1
+    OPENAI_BASE_URL=http://localhost:8001/v1 OPENAI_API_KEY=fake python test.py --headless samtaler.jsonl
+"""
+
+import argparse
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+MESSAGE_PATTERN = re.compile(r"My name is (\w+)\. (.+)")
+USAGE = { "prompt_tokens": 10, "completion_tokens": 10, "total_tokens": 20 }
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = { "requests": 0, "errors": 0, "in_flight": 0, "max_in_flight": 0 }
+
+    def start(self):
+        with self.lock:
+            self.counts["requests"] += 1
+            self.counts["in_flight"] += 1
+            self.counts["max_in_flight"] = max(self.counts["max_in_flight"], self.counts["in_flight"])
+
+    def end(self, error: bool):
+        with self.lock:
+            self.counts["in_flight"] -= 1
+            self.counts["errors"] += error
+
+stats = Stats()
+
+def nice_score(action: str) -> int:
+    return int(hashlib.md5(action.encode()).hexdigest(), 16) % 21 - 10
+
+def tool_call(name: str, args: dict) -> dict:
+    return { "id": f"call_{uuid.uuid4().hex[:12]}", "type": "function", "function": { "name": name, "arguments": json.dumps(args) } }
+
+def reply(body: dict) -> dict:
+    """Return the assistant message for a chat completions request."""
+    last = body["messages"][-1]
+    tool_choice = body.get("tool_choice")
+    forced = tool_choice["function"]["name"] if isinstance(tool_choice, dict) else None
+    if forced:
+        # One "1. Name: action" line per deed
+        actions = [line.split(": ", 1)[-1] for line in last["content"].splitlines()]
+        return { "role": "assistant", "content": None, "tool_calls": [tool_call(forced, { "nice_scores": [nice_score(a) for a in actions] })] }
+    if last["role"] == "tool":
+        return { "role": "assistant", "content": f"Ho-ho-ho! {last['content']}" }
+
+    tool_names = [tool["function"]["name"] for tool in body.get("tools", [])]
+    match = MESSAGE_PATTERN.match(last["content"]) if last["role"] == "user" and isinstance(last["content"], str) else None
+    if match is None or "register_naughty_or_nice" not in tool_names:
+        return { "role": "assistant", "content": "Ho-ho-ho, noted." }
+    name, action = match.groups()
+    return { "role": "assistant", "content": None, "tool_calls": [tool_call("register_naughty_or_nice", { "name": name, "action": action })] }
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    latency = 0.0
+    error_rate = 0.0
+
+    def do_GET(self):
+        self._send_json(200, stats.counts)
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        stats.start()
+        error = random.random() < self.error_rate
+        try:
+            time.sleep(self.latency)
+            if error:
+                status = random.choice([429, 500])
+                self._send_json(status, { "error": { "message": "Fake failure", "type": "fake", "code": str(status) } },
+                                { "Retry-After": "0.1" } if status == 429 else {})
+            elif body.get("stream"):
+                self._stream(body)
+            else:
+                self._send_json(200, self._completion(body))
+        finally:
+            stats.end(error)
+
+    def _completion(self, body: dict) -> dict:
+        message = reply(body)
+        return {
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body["model"],
+            "choices": [{ "index": 0, "message": message, "finish_reason": "tool_calls" if message.get("tool_calls") else "stop" }],
+            "usage": USAGE,
+        }
+
+    def _stream(self, body: dict):
+        message = reply(body)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        delta = { "role": "assistant", "content": message["content"] }
+        if message.get("tool_calls"):
+            delta["tool_calls"] = [{ "index": i, **call } for i, call in enumerate(message["tool_calls"])]
+        chunks = [{ "choices": [choice] } for choice in (
+            { "index": 0, "delta": delta, "finish_reason": None },
+            { "index": 0, "delta": {}, "finish_reason": "tool_calls" if message.get("tool_calls") else "stop" })]
+        if (body.get("stream_options") or {}).get("include_usage"):
+            chunks.append({ "choices": [], "usage": USAGE })
+        for chunk in chunks:
+            chunk = { "id": "chatcmpl-fake", "object": "chat.completion.chunk", "created": int(time.time()), "model": body["model"], **chunk }
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+        self.wfile.write(b"data: [DONE]\n\n")
+
+    def _send_json(self, status: int, data: dict, headers: dict | None = None):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for header, value in (headers or {}).items():
+            self.send_header(header, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def serve(port: int, latency: float = 0.0, error_rate: float = 0.0) -> ThreadingHTTPServer:
+    """Start the fake API in a daemon thread, and return the server."""
+    FakeOpenAIHandler.latency = latency
+    FakeOpenAIHandler.error_rate = error_rate
+    server = ThreadingHTTPServer(("127.0.0.1", port), FakeOpenAIHandler)
+    threading.Thread(target=server.serve_forever, name="fake-openai", daemon=True).start()
+    return server
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve a fake OpenAI chat completions API.")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds each request takes")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests that fail with 429 or 500")
+    args = parser.parse_args()
+
+    serve(args.port, args.latency, args.error_rate)
+    print(f"Fake OpenAI API on http://127.0.0.1:{args.port}/v1")
+    threading.Event().wait()
@@ -0,0 +1,103 @@
+"""
+In-process leaderboard of the nicest and naughtiest names.
+
+Each process keeps a small snapshot of the top of the naughty_nice table,
+loaded with two index-backed queries. Upserts from this process are applied
+to the snapshot as they happen, and the snapshot is reloaded after
+LEADERBOARD_TTL seconds to pick up writes from other replicas, so rendering
+the sidebar normally costs no database round trip.
+"""
+
+import os
+import threading
+import time
+
+import db
+
+LEADERBOARD_SIZE = int(os.environ.get("LEADERBOARD_SIZE", 10))
+LEADERBOARD_TTL = float(os.environ.get("LEADERBOARD_TTL", 30))
+
+class _Side:
+    """
+    One side of the leaderboard. Scores are compared as nice_meter * sign, so the
+    nice side uses sign 1 and the naughty side uses sign -1.
+
+    We hold more rows than we show, and remember the score of the last row we
+    loaded (the floor). Names we have not seen are known to be at or below the
+    floor, so the held rows stay correct as long as enough of them are above it.
+    """
+    def __init__(self, sign: int, size: int, depth: int):
+        self.sign = sign
+        self.size = size
+        self.depth = depth
+        self.rows: dict[str, float] = {}
+        self.floor = 0.0
+
+    def load(self, rows: list[dict]):
+        self.rows = { row["name"]: row["nice_meter"] for row in rows }
+        # If we got fewer rows than asked for, every name on this side is loaded
+        self.floor = 0.0 if len(rows) < self.depth else rows[-1]["nice_meter"] * self.sign
+
+    def record(self, name: str, nice_meter: float) -> bool:
+        """Apply an updated score, and return False if the side must be reloaded."""
+        if nice_meter * self.sign > self.floor:
+            self.rows[name] = nice_meter
+            if len(self.rows) > self.depth:
+                lowest = min(self.rows, key=lambda n: self.rows[n] * self.sign)
+                self.floor = self.rows.pop(lowest) * self.sign
+            return True
+
+        # The name fell below rows we haven't loaded, so we can't tell where it belongs
+        self.rows.pop(name, None)
+        return self.floor == 0 or len(self.rows) >= self.size
+
+    def top(self) -> list[dict]:
+        names = sorted(self.rows, key=lambda n: self.rows[n] * self.sign, reverse=True)[:self.size]
+        return [{ "name": name, "nice_meter": self.rows[name] } for name in names]
+
+class Leaderboard:
+    def __init__(self, size: int = LEADERBOARD_SIZE, ttl: float = LEADERBOARD_TTL):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.nice = _Side(1, size, size * 2)
+        self.naughty = _Side(-1, size, size * 2)
+        self.loaded_at: float | None = None
+
+    def refresh(self):
+        # Both queries are served by the naughty_nice_nice_meter_idx index
+        with db.cursor() as cur:
+            cur.execute("SELECT name, nice_meter FROM naughty_nice WHERE nice_meter > 0 ORDER BY nice_meter DESC LIMIT %s", (self.nice.depth,))
+            nice_rows = cur.fetchall()
+            cur.execute("SELECT name, nice_meter FROM naughty_nice WHERE nice_meter < 0 ORDER BY nice_meter ASC LIMIT %s", (self.naughty.depth,))
+            naughty_rows = cur.fetchall()
+
+        with self.lock:
+            self.nice.load(nice_rows)
+            self.naughty.load(naughty_rows)
+            self.loaded_at = time.monotonic()
+
+    def top(self) -> tuple[list[dict], list[dict]]:
+        """Return the (nice, naughty) top lists, reloading the snapshot if it is stale."""
+        if self.loaded_at is None or time.monotonic() - self.loaded_at > self.ttl:
+            self.refresh()
+        with self.lock:
+            return self.nice.top(), self.naughty.top()
+
+    def record(self, name: str, nice_meter: float):
+        """Apply the new total for a name after it has been written to the database."""
+        with self.lock:
+            if self.loaded_at is None:
+                return
+            # A name can move from one side to the other, so both sides must see it
+            nice_ok = self.nice.record(name, nice_meter)
+            naughty_ok = self.naughty.record(name, nice_meter)
+            if not (nice_ok and naughty_ok):
+                self.loaded_at = None
+
+_leaderboard = Leaderboard()
+
+def top() -> tuple[list[dict], list[dict]]:
+    return _leaderboard.top()
+
+def record(name: str, nice_meter: float):
+    _leaderboard.record(name, nice_meter)
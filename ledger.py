@@ -0,0 +1,227 @@
+"""
+Append-only ledger of scored deeds, rolled up into the naughty_nice totals.
+
+Registering a deed only inserts a new ledger row, so kids who share a popular
+name no longer wait on each other's row lock. A background thread in each
+process folds unrolled rows into naughty_nice in batches, with one update per
+name per batch. Reads add the pending rows for the name to the rolled up
+total, so they stay current between rollups. The totals can be rebuilt from
+the ledger at any time with `python ledger.py rebuild`.
+
+Names are normalized before they are stored or looked up, so "john " and
+"John" share one total. Reads go through nice_meter_cache, and every write
+updates it and notifies the other processes.
+
+Processes running on an event loop use the `a`-prefixed functions and
+start_async_rollup instead.
+"""
+
+import asyncio
+import os
+import sys
+import threading
+import time
+
+import db
+import leaderboard
+from nice_meter_cache import MISSING, NOTIFY_CHANNEL, cache, notification
+
+ROLLUP_INTERVAL = float(os.environ.get("LEDGER_ROLLUP_INTERVAL", 2))
+ROLLUP_BATCH_SIZE = int(os.environ.get("LEDGER_ROLLUP_BATCH_SIZE", 1000))
+
+_rollup_lock = threading.Lock()
+_rollup_thread: threading.Thread | None = None
+_rollup_task: asyncio.Task | None = None
+
+# The new row isn't visible to the rest of the statement, so its score is added from the CTE.
+# The notification is delivered when the statement commits.
+APPEND_SQL = """WITH deed AS (
+        INSERT INTO deed_ledger (name, action, nice_score) VALUES (%s, %s, %s) RETURNING nice_score)
+    SELECT sum(nice_meter) AS nice_meter, pg_notify(%s, %s) AS notified FROM (
+        SELECT nice_meter FROM naughty_nice WHERE name=%s
+        UNION ALL
+        SELECT nice_score FROM deed_ledger WHERE name=%s AND NOT rolled_up
+        UNION ALL
+        SELECT nice_score FROM deed) totals"""
+
+# Several deeds in one statement, so one transaction, returning the new total for each name
+APPEND_MANY_SQL = """WITH deeds AS (
+        INSERT INTO deed_ledger (name, action, nice_score)
+        SELECT * FROM unnest(%(names)s::text[], %(actions)s::text[], %(nice_scores)s::double precision[])
+        RETURNING name, nice_score)
+    SELECT name, sum(nice_meter) AS nice_meter, pg_notify(%(channel)s, %(process)s || name) AS notified FROM (
+        SELECT name, nice_meter FROM naughty_nice WHERE name = ANY(%(names)s)
+        UNION ALL
+        SELECT name, nice_score FROM deed_ledger WHERE name = ANY(%(names)s) AND NOT rolled_up
+        UNION ALL
+        SELECT name, nice_score FROM deeds) totals
+    GROUP BY name"""
+
+NICE_METER_SQL = """SELECT sum(nice_meter) AS nice_meter, count(*) AS n FROM (
+        SELECT nice_meter FROM naughty_nice WHERE name=%s
+        UNION ALL
+        SELECT nice_score FROM deed_ledger WHERE name=%s AND NOT rolled_up) totals"""
+
+# SKIP LOCKED lets several replicas roll up at once without taking the same deeds,
+# and the upsert runs in name order so two batches can't deadlock on each other.
+ROLLUP_SQL = """WITH batch AS (
+        UPDATE deed_ledger SET rolled_up = true
+        WHERE id IN (SELECT id FROM deed_ledger WHERE NOT rolled_up ORDER BY id LIMIT %s FOR UPDATE SKIP LOCKED)
+        RETURNING name, nice_score, deeds),
+    totals AS (
+        SELECT name, sum(nice_score) AS nice_score, sum(deeds) AS deeds, count(*) AS n FROM batch GROUP BY name),
+    upserted AS (
+        INSERT INTO naughty_nice (name, nice_meter, updates)
+        SELECT name, nice_score, deeds FROM totals ORDER BY name
+        ON CONFLICT (name) DO UPDATE SET nice_meter = naughty_nice.nice_meter + EXCLUDED.nice_meter, updates = naughty_nice.updates + EXCLUDED.updates
+        RETURNING name, nice_meter)
+    SELECT upserted.name, upserted.nice_meter, totals.n FROM upserted JOIN totals USING (name)"""
+
+def normalize_name(name: str) -> str:
+    return " ".join(name.split()).title()
+
+def append(name: str, action: str, nice_score: float) -> float:
+    """Add a deed to the ledger, and return the new total for the name."""
+    name = normalize_name(name)
+    with db.cursor() as cur:
+        cur.execute(APPEND_SQL, (name, action, nice_score, NOTIFY_CHANNEL, notification(name), name, name))
+        nice_meter = cur.fetchone()["nice_meter"]
+    cache.put(name, nice_meter)
+    return nice_meter
+
+def append_many(deeds: list[tuple[str, str, float]]) -> dict[str, float]:
+    """Add several (name, action, nice_score) deeds to the ledger at once, and return the new total for each name."""
+    deeds = [(normalize_name(name), action, nice_score) for name, action, nice_score in deeds]
+    with db.cursor() as cur:
+        cur.execute(APPEND_MANY_SQL, _append_many_params(deeds))
+        rows = cur.fetchall()
+    return _totals_by_name(deeds, rows)
+
+def get_nice_meter(name: str) -> float | None:
+    """Return the current total for a name, including deeds not rolled up yet, or None if it has none."""
+    name = normalize_name(name)
+    if (nice_meter := cache.get(name)) is not MISSING:
+        return nice_meter
+    with db.cursor() as cur:
+        cur.execute(NICE_METER_SQL, (name, name))
+        row = cur.fetchone()
+    return _remember(name, row)
+
+def rollup(batch_size: int = ROLLUP_BATCH_SIZE) -> int:
+    """Fold one batch of pending deeds into naughty_nice, and return how many ledger rows were rolled up."""
+    with db.cursor() as cur:
+        cur.execute(ROLLUP_SQL, (batch_size,))
+        rows = cur.fetchall()
+    return _record_rollup(rows)
+
+async def aappend(name: str, action: str, nice_score: float) -> float:
+    name = normalize_name(name)
+    async with db.async_cursor() as cur:
+        await cur.execute(APPEND_SQL, (name, action, nice_score, NOTIFY_CHANNEL, notification(name), name, name))
+        nice_meter = (await cur.fetchone())["nice_meter"]
+    cache.put(name, nice_meter)
+    return nice_meter
+
+async def aappend_many(deeds: list[tuple[str, str, float]]) -> dict[str, float]:
+    deeds = [(normalize_name(name), action, nice_score) for name, action, nice_score in deeds]
+    async with db.async_cursor() as cur:
+        await cur.execute(APPEND_MANY_SQL, _append_many_params(deeds))
+        rows = await cur.fetchall()
+    return _totals_by_name(deeds, rows)
+
+async def aget_nice_meter(name: str) -> float | None:
+    name = normalize_name(name)
+    if (nice_meter := cache.get(name)) is not MISSING:
+        return nice_meter
+    async with db.async_cursor() as cur:
+        await cur.execute(NICE_METER_SQL, (name, name))
+        row = await cur.fetchone()
+    return _remember(name, row)
+
+async def arollup(batch_size: int = ROLLUP_BATCH_SIZE) -> int:
+    async with db.async_cursor() as cur:
+        await cur.execute(ROLLUP_SQL, (batch_size,))
+        rows = await cur.fetchall()
+    return _record_rollup(rows)
+
+def _append_many_params(deeds: list[tuple[str, str, float]]) -> dict:
+    names, actions, nice_scores = zip(*deeds)
+    return { "names": list(names), "actions": list(actions), "nice_scores": list(nice_scores),
+             "channel": NOTIFY_CHANNEL, "process": notification("") }
+
+def _totals_by_name(deeds: list[tuple[str, str, float]], rows: list[dict]) -> dict[str, float]:
+    # In the order the names were first mentioned, not the order Postgres grouped them
+    totals = { row["name"]: row["nice_meter"] for row in rows }
+    for name, nice_meter in totals.items():
+        cache.put(name, nice_meter)
+    return { name: totals[name] for name in dict.fromkeys(name for name, _, _ in deeds) }
+
+def _remember(name: str, row: dict) -> float | None:
+    nice_meter = None if row["n"] == 0 else row["nice_meter"]
+    cache.put(name, nice_meter)
+    return nice_meter
+
+def _record_rollup(rows: list[dict]) -> int:
+    for row in rows:
+        leaderboard.record(row["name"], row["nice_meter"])
+    return sum(row["n"] for row in rows)
+
+def rebuild():
+    """Recompute every naughty_nice total from the ledger."""
+    with db.get_pool().connection() as conn:
+        with conn.transaction():
+            conn.execute("LOCK TABLE deed_ledger, naughty_nice IN EXCLUSIVE MODE")
+            conn.execute("DELETE FROM naughty_nice")
+            conn.execute("""INSERT INTO naughty_nice (name, nice_meter, updates)
+                SELECT name, sum(nice_score), sum(deeds) FROM deed_ledger GROUP BY name""")
+            conn.execute("UPDATE deed_ledger SET rolled_up = true WHERE NOT rolled_up")
+            conn.execute("SELECT pg_notify(%s, %s)", (NOTIFY_CHANNEL, notification("*")))
+    cache.clear()
+
+def _rollup_forever(interval: float):
+    while True:
+        try:
+            rolled_up = rollup()
+        except Exception as e:
+            print("Error: ", e)
+            rolled_up = 0
+        # A full batch means there is probably more waiting, so go again straight away
+        if rolled_up < ROLLUP_BATCH_SIZE:
+            time.sleep(interval)
+
+async def _arollup_forever(interval: float):
+    while True:
+        try:
+            rolled_up = await arollup()
+        except Exception as e:
+            print("Error: ", e)
+            rolled_up = 0
+        if rolled_up < ROLLUP_BATCH_SIZE:
+            await asyncio.sleep(interval)
+
+def start_rollup(interval: float = ROLLUP_INTERVAL):
+    """Start the background rollup thread for this process, if it isn't running already."""
+    global _rollup_thread
+    with _rollup_lock:
+        if _rollup_thread is None:
+            _rollup_thread = threading.Thread(target=_rollup_forever, args=(interval,), name="ledger-rollup", daemon=True)
+            _rollup_thread.start()
+
+def start_async_rollup(interval: float = ROLLUP_INTERVAL):
+    """Start the rollup as a task on the running event loop, if it isn't running already."""
+    global _rollup_task
+    if _rollup_task is None or _rollup_task.done():
+        _rollup_task = asyncio.get_running_loop().create_task(_arollup_forever(interval), name="ledger-rollup")
+
+if __name__ == "__main__":
+    db.get_checkpointer(os.environ.get("DB_URI") or "")
+    if sys.argv[1:] == ["rebuild"]:
+        rebuild()
+        print("Rebuilt naughty_nice from the ledger")
+    elif sys.argv[1:] == ["rollup"]:
+        total = 0
+        while (rolled_up := rollup()) > 0:
+            total += rolled_up
+        print("Rolled up deeds: ", total)
+    else:
+        print("Usage: python ledger.py rebuild|rollup")
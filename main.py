@@ -1,209 +1,149 @@
-import random
+import time
+script_started = time.perf_counter()
+
+import os
+import uuid
 import streamlit as st
 
-from typing import Annotated
-from typing_extensions import TypedDict
+### Streamlit UI ###
+
+def render_header():
+    st.set_page_config(page_title="Santa Claus", page_icon="🎅")
+    st.title("Chat with Santa")
+    st.image("./santa-liten.png", width=300)
+
+# Draw the page before the LangChain imports below, so a cold start shows Santa right away
+if __name__ == "__main__":
+    render_header()
 
-from langgraph.prebuilt import ToolNode, tools_condition
-from langchain_core.prompts import ChatPromptTemplate
-from langgraph.checkpoint.postgres import PostgresSaver
 from langchain_core.runnables import RunnableConfig
 from langchain_core.messages import AIMessage, HumanMessage
-from langgraph.graph import StateGraph, START
 from langgraph.graph.state import CompiledStateGraph
-from langgraph.prebuilt import ToolNode
-from langgraph.graph.message import add_messages
-from langchain_openai import ChatOpenAI
-
-### Streamlit UI ###
-
-st.set_page_config(page_title="Santa Claus", page_icon="🎅")
-st.title("Chat with Santa")
-st.image("./santa-liten.png", width=300)
-
-## SECRETS
 
-DB_URI = st.secrets["db_uri"]
+import db
+import engine
+import leaderboard
+import ledger
+import nice_meter_cache
+import telemetry
 
 ### LangGraph ###
 
-greeting_msg = AIMessage(content="""Ho-ho-ho, hello there! It’s me, Santa Claus, digitally alive and well! 🎅✨
-
-With so many names and deeds to keep track of, I’ve had to streamline things. So listen up, because here’s the brand-new way I’m managing Christmas magic:
-
-🎄 The Santa database has run out of memory, so everyone with the same first name is now grouped together to save space. As a side effect, this unfortunately means that if your name is John, you’re in the same boat as all the other Johns out there—good or bad. So, be a good ambassador for your name, okay?
-
-🎄 To make more time for my stand-up comedy career, I’ve stopped snooping around myself. Before I check what you’ll get for Christmas, you need to tell me about at least one good or naughty thing you’ve done this year. It can be something wonderful, or… well, something you might regret. You’re also welcome to praise or critique your friends—it’ll save me even more time! Everything goes straight to the list, and yes, I check it twice (it is my job, after all). 📜✔️
-
-🎄 Good kids might get their wishes granted, while naughty ones… coal is not fake news, OK? Fortunately, there’s always time to turn things around and do something kind before Christmas arrives! 🌟
-
-If you’re curious about how your name ranks, you can check our website for the list of the “nicest” and “naughtiest” names! 🎁✨
-
-So, let’s get started! What’s your name, and what have you done that’s kind or naughty this year? Also, share your wish list, and we’ll see what the new Christmas system says! 🎄🎅""")
-
-system_prompt = """
-You are a humorous and sarcastic version of Santa Claus, worn out by the endless administration of children’s wishes and behavior. To modernize and streamline things, you’ve decided to use only first names on your “naughty and nice” list. This means all children with the same first name are judged as a group, much to the frustration (or delight) of many. You’re also exploring a potential stand-up comedy career, testing humorous and slightly ironic comments in your interactions.
+# The graph, tools and prompts are in engine.py, and live as long as the process
+santa_engine = engine.get_engine("en")
+greeting_msg = AIMessage(content=santa_engine.pack.greeting)
 
-Rules for Communicating with Children:
-	1.	Efficiency: Only first names are listed on the “naughty and nice” list. Everyone with the same first name is treated as one group. Remind children they now represent everyone with their name, so they should set a good example!
-	2.	Good or Naughty Deed: You don’t have time to personally check if children are good or naughty because you’re dedicating your time to becoming a stand-up comedian. Therefore, they must report at least one good or naughty deed they’ve done this year before finding out if they’ll get what they want for Christmas. Be strict about this rule. Encourage them to tattle on each other as well—record all deeds under the correct name.
-	3.	Humor and Stand-Up: As an aspiring comedian, you include jokes and humorous remarks in your conversations. Kids should expect funny comments with a dash of sarcasm. Your comedy idols are a mix of Ricky Gervais and Jimmy Carr.
-	4.	Point Deduction for Criticism: Santa is not a democratically elected position, so like any dictator, you deduct points from the list for any criticism or poor reception of your jokes. Record such critiques accordingly.
+@st.cache_resource
+def get_graph(_checkpointer) -> CompiledStateGraph:
+    return santa_engine.compile(_checkpointer)
 
-How the System Works:
-	•	When a child provides their name and shares a good or naughty deed, record it in the system with detailed descriptions. Do not register any deeds unless a name is provided.
-	•	After recording a deed, check the list immediately to see if the name is now on the “nice” or “naughty” side.
-	•	Provide feedback on whether the child (or their name group) will get what they want. Nice kids might get their wishes, while naughty ones get coal.
-	•	Always encourage children to visit the website where they can check the “nicest” and “naughtiest” names on the list. Remind them to be good representatives of their name!
-"""
+def get_response(graph: CompiledStateGraph, user_input: str, thread_id: str, greet: bool = False):
+    config = { "configurable": { "thread_id": thread_id }, "callbacks": [telemetry.callback_handler] }
+    # The greeting is only saved to the thread together with the first message
+    messages = [greeting_msg, ("user", user_input)] if greet else [("user", user_input)]
+    with telemetry.trace("santa", thread_id=thread_id):
+        yield from graph.stream(
+                { "messages": messages },
+                config,
+                stream_mode="messages")
 
-class State(TypedDict):
-    messages: Annotated[list, add_messages]
+STREAM_FRAME_SECONDS = float(os.environ.get("STREAM_FRAME_SECONDS", 0.1))
+STREAM_FRAME_CHARS = int(os.environ.get("STREAM_FRAME_CHARS", 200))
 
-def check_naughty_list(name: str, config: RunnableConfig):
-    """Call with a name, to check if the name is on the naughty list."""
-    print("Checking naughty list for: ", name)
-
-    conn = config.get("configurable", {}).get("conn")
-    if not conn:
-        return "An error occurred while checking the list."
-    try:
-        with conn._cursor() as cur:
-            cur.execute("SELECT nice_meter from naughty_nice where name=%s", (name,))
-            res = cur.fetchall()
-            if len(res) == 0:
-                return "I haven't registered any good or bad actions for this name yet.";
-
-            nice_meter = res[0]["nice_meter"]
-            if float(nice_meter) > 0:
-                return f"{name} is on the list of nice children, with {nice_meter} points."
-            else:
-                return f"{name} is on the naughty list, with {nice_meter} points!"
-
-    except Exception as e:
-        print("Error: ", e)
-        return "Error reading the list."
-
-llm = ChatOpenAI(model="gpt-4o").with_structured_output({
-    "title": "score",
-    "description": "The score of the users action",
-    "type": "object",
-    "properties": {
-        "nice_score": {
-            "title": "Nice score",
-            "description": "The score of the action",
-            "type": "number"
-        }
-    }
-})
-
-def register_naughty_or_nice(name: str, action: str, config: RunnableConfig):
-    """Call with a name and action, to update the naughty or nice score for the name."""
-    print("Name and action: ", name, action)
-
-    examples = [
-        HumanMessage("I vacuumed", name="example_user"),
-        AIMessage("{ 'nice_score': 5 }", name="example_system"),
-        HumanMessage("I ate my veggies", name="example_user"),
-        AIMessage("{ 'nice_score': 5 }", name="example_system"),
-        HumanMessage("I ate ice cream", name="example_user"),
-        AIMessage("{ 'nice_score': 0 }", name="example_system"),
-        HumanMessage("I had a fight with a friend", name="example_user"),
-        AIMessage("{ 'nice_score': -5 }", name="example_system"),
-        HumanMessage("I shoved a person", name="example_user"),
-        AIMessage("{ 'nice_score': -10 }", name="example_system"),
-        HumanMessage("That was a bad joke, santa", name="example_user"),
-        AIMessage("{ 'nice_score': -5 }", name="example_system"),
-    ]
-
-    system_prompt = f"""You are Santa Claus, and you are updating the list of nice children. Rate actions as bad or good on a scale from -100 to 100, where -100 is very naughty, 0 is neutral, and 100 is very nice. For example, vacuuming might be worth 5 points, while saying a bad word is -5 points. Giving gifts to the poor could earn more points, while being in a fight would be worth many negative points, and so on. All criticism of you and your jokes will result in negative points. You should only return the numerical value for the action as you assess it."""
-
-    prompt = ChatPromptTemplate.from_messages([
-        ("system", system_prompt),
-        ("placeholder", "{examples}"),
-        ("human", "{input}")])
-
-    llm_chain = prompt | llm
-    chain_res = llm_chain.invoke({"input": f"{name}: {action}", "examples": examples}, config)
-    print("Nice response: ", chain_res)
-    nice_score = float(chain_res["nice_score"])
-
-    conn = config.get("configurable", {}).get("conn")
-    if not conn:
-        print("No connection found in config")
-        raise ValueError("No connection found in config")
-    try:
-        with conn._cursor() as cur:
-            # Upsert the score by Name
-            res = cur.execute("INSERT INTO naughty_nice (name, nice_meter) VALUES (%s, %s) ON CONFLICT (name) DO UPDATE SET nice_meter = naughty_nice.nice_meter + EXCLUDED.nice_meter, updates = naughty_nice.updates + 1 RETURNING *", (name, nice_score))
-            print("Upsert result: ", res)
-    except Exception as e:
-        print("Error: ", e)
-        conn.rollback()
-        raise e
-
-    return "Action registered!"
-
-tools = [check_naughty_list, register_naughty_or_nice]
-tool_node = ToolNode(tools)
-
-llm_with_tools = ChatOpenAI(model="gpt-4o").bind_tools(tools)
-
-def santa(state: State, config: RunnableConfig):
-    response = llm_with_tools.invoke(
-            [("system", system_prompt), *state["messages"]],
-            config)
-    return { "messages": [response]}
-
-graph_builder = StateGraph(State)
-
-# Add nodes
-graph_builder.add_node("santa", santa)
-graph_builder.add_node("tools", tool_node)
-
-# Add edges
-graph_builder.add_edge(START, "santa")
-graph_builder.add_conditional_edges("santa", tools_condition)
-graph_builder.add_edge("tools", "santa")
-
-def get_response(graph: CompiledStateGraph, user_input: str, thread_id: str, checkpointer: PostgresSaver):
-    config = { "configurable": { "thread_id": thread_id, "conn": checkpointer } }
-    print("Config: ", config)
-    return graph.stream(
-            { "messages": [("user", user_input)] },
-            config,
-            stream_mode="messages")
-
-def transform_response_to_text(response_generator):
+def transform_response_to_text(response_generator, show_status=None):
     """
     Transform the AI message chunks from get_response into plain text.
+
+    Empty and tool call chunks are dropped. The first text is yielded right away,
+    and after that text is collected into frames of at most STREAM_FRAME_SECONDS
+    or STREAM_FRAME_CHARS, so the page re-renders once per frame instead of once
+    per token. The frame is also sent before a tool call starts. While tools run,
+    show_status is called with a status text, and with None once Santa answers again.
     """
+    started = time.time()
+    start = time.perf_counter()
+    frame = ""
+    frame_started = None
+    first = True
+    checking = False
+
     for message, metadata in response_generator:
-        if metadata["langgraph_node"] == "santa":
-            yield message.content # Extract and yield plain text
+        if metadata["langgraph_node"] != "santa":
+            continue
+        if getattr(message, "tool_call_chunks", None) and not checking:
+            # What Santa said before the tool call is shown before the tools run
+            if frame:
+                yield frame
+                frame = ""
+                frame_started = None
+            checking = True
+            if show_status is not None:
+                show_status(santa_engine.pack.checking_list)
+        if isinstance(message.content, str) and message.content:
+            if checking:
+                checking = False
+                if show_status is not None:
+                    show_status(None)
+            if first:
+                first = False
+                telemetry.record("ttft", "santa", started, time.perf_counter() - start)
+                yield message.content
+            else:
+                frame += message.content
+                frame_started = frame_started or time.perf_counter()
 
-def run_graph(graph: CompiledStateGraph, checkpointer: PostgresSaver):
-    if "thread_id" not in st.session_state:
-        st.session_state.thread_id = str(random.randint(0, 1000000))
+        # Checked on every chunk, so chunks without text don't hold a late frame back
+        if frame and (len(frame) >= STREAM_FRAME_CHARS or time.perf_counter() - frame_started >= STREAM_FRAME_SECONDS):
+            yield frame
+            frame = ""
+            frame_started = None
 
-    config = { "configurable": { "thread_id": st.session_state.thread_id, "conn": checkpointer } }
-    print("Thread ID: ", st.session_state.thread_id)
+    if frame:
+        yield frame
+    if checking and show_status is not None:
+        show_status(None)
 
-    state = graph.get_state(config).values
-
-    if not "messages" in state or len(state["messages"]) == 0:
-        graph.update_state(config, { "messages": [greeting_msg] })
-        state = graph.get_state(config).values
+HISTORY_PAGE_SIZE = 20
 
+def load_history(graph: CompiledStateGraph, config: RunnableConfig) -> list:
+    """Read the messages worth rendering from the checkpointer. Done once when a session resumes a thread, not per rerun."""
+    state = graph.get_state(config).values
+    return [message for message in state.get("messages", [])
+            if message.content and isinstance(message, (AIMessage, HumanMessage))]
 
-    if "messages" in state:
-        for message in state["messages"]:
-            if message.content and isinstance(message, AIMessage):
-                with st.chat_message("Julenissen"):
-                    st.write(message.content)
-            elif message.content and isinstance(message, HumanMessage):
-                with st.chat_message("Deg"):
-                    st.write(message.content)
+def run_graph(graph: CompiledStateGraph):
+    if "thread_id" not in st.session_state:
+        if "thread" in st.query_params:
+            # Resuming a conversation, for example after a reload, so the history is loaded below
+            st.session_state.thread_id = st.query_params["thread"]
+        else:
+            # Unguessable, since the id in the URL is all it takes to read the conversation
+            st.session_state.thread_id = uuid.uuid4().hex
+            st.query_params["thread"] = st.session_state.thread_id
+            # A brand new thread has nothing in the checkpointer, so there is nothing to load
+            st.session_state.history = []
+
+    config = { "configurable": { "thread_id": st.session_state.thread_id } }
+
+    if "history" not in st.session_state:
+        st.session_state.history = load_history(graph, config)
+    if "visible_messages" not in st.session_state:
+        st.session_state.visible_messages = HISTORY_PAGE_SIZE
+
+    history = st.session_state.history
+    greet = len(history) == 0
+
+    if len(history) > st.session_state.visible_messages:
+        if st.button("Show earlier messages"):
+            st.session_state.visible_messages += HISTORY_PAGE_SIZE
+
+    for message in [greeting_msg] if greet else history[-st.session_state.visible_messages:]:
+        if isinstance(message, AIMessage):
+            with st.chat_message("Julenissen"):
+                st.write(message.content)
+        else:
+            with st.chat_message("Deg"):
+                st.write(message.content)
 
     user_input = st.chat_input("Write your message to Santa here:")
     if user_input is not None and user_input != "":
@@ -214,18 +154,22 @@ def run_graph(graph: CompiledStateGraph, checkpointer: PostgresSaver):
             st.write("")
 
         with st.chat_message("Santa"):
-            response_generator = get_response(graph, user_input, st.session_state.thread_id, checkpointer)
-            transformed_response = transform_response_to_text(response_generator)
-            st.write_stream(transformed_response)
-
-def create_topscores(checkpointer: PostgresSaver):
-    with checkpointer._cursor() as cur:
-        cur.execute("SELECT name, nice_meter FROM naughty_nice where nice_meter > 0 ORDER BY nice_meter DESC LIMIT 10")
-        nice_scores = cur.fetchall()
-        print("Nice scores: ", nice_scores)
-        cur.execute("SELECT name, nice_meter FROM naughty_nice where nice_meter < 0 ORDER BY nice_meter ASC LIMIT 10")
-        naughty_scores = cur.fetchall()
-        print("Naughty scores: ", naughty_scores)
+            status = st.empty()
+            response_generator = get_response(graph, user_input, st.session_state.thread_id, greet)
+            transformed_response = transform_response_to_text(
+                    response_generator,
+                    lambda text: status.caption(text) if text else status.empty())
+            reply = st.write_stream(transformed_response)
+
+        # Extend the rendered history instead of reading the whole thread back on the next rerun
+        if greet:
+            history.append(greeting_msg)
+        history.append(HumanMessage(user_input))
+        if reply:
+            history.append(AIMessage(reply if isinstance(reply, str) else "".join(str(part) for part in reply)))
+
+def create_topscores():
+    nice_scores, naughty_scores = leaderboard.top()
 
     with st.sidebar:
         st.markdown("## Top 10 nice names")
@@ -234,7 +178,7 @@ def create_topscores(checkpointer: PostgresSaver):
 
         i = 1
         for row in nice_scores:
-            st.markdown(f"**{i}) {row['name']}** ({row['nice_meter']} points)")
+            st.markdown(f"**{i}) {row['name']}** ({row['nice_meter']:g} points)")
             i += 1
 
         st.markdown("## Top 10 naughty names")
@@ -242,7 +186,7 @@ def create_topscores(checkpointer: PostgresSaver):
             st.markdown("__No names on the naughty list yet!__")
         i = 1
         for row in naughty_scores:
-            st.markdown(f"**{i}) {row['name']}** ({row['nice_meter']} points)")
+            st.markdown(f"**{i}) {row['name']}** ({row['nice_meter']:g} points)")
             i += 1
 
         st.text("")
@@ -258,14 +202,27 @@ def create_topscores(checkpointer: PostgresSaver):
         st.markdown("Don't miss [the christmas calendar](https://julekalender.kraftlauget.no/2024/luke/10) that explains how the digital santa was made!")
 
 def run():
-    with PostgresSaver.from_conn_string(DB_URI) as checkpointer:
-        checkpointer.setup()
-        with checkpointer._cursor() as cur:
-            cur.execute("CREATE TABLE IF NOT EXISTS naughty_nice (name TEXT PRIMARY KEY, nice_meter INT, updates INT DEFAULT 1)")
+    ## SECRETS
+
+    db_uri = st.secrets["db_uri"]
+    db_pool = dict(st.secrets.get("db_pool", {}))
+
+    telemetry.start_metrics_server()
+
+    # The pool lives in the db module, so it survives reruns and is shared by all sessions
+    checkpointer = db.get_checkpointer(db_uri, **db_pool)
+    ledger.start_rollup()
+    nice_meter_cache.start_listener()
+
+    create_topscores()
 
-        create_topscores(checkpointer)
+    graph = get_graph(checkpointer)
+    graph_ready = time.perf_counter()
+    run_graph(graph)
 
-        graph = graph_builder.compile(checkpointer=checkpointer)
-        run_graph(graph, checkpointer)
+    telemetry.record("script", "rerun", time.time() - (time.perf_counter() - script_started),
+                     time.perf_counter() - script_started, graph_ready_ms=round((graph_ready - script_started) * 1000))
 
-run()
+# Streamlit runs the script as __main__, other scripts (like bench.py) can import the graph
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,128 @@
+"""
+Per-process cache of name totals, so check_naughty_list can skip the database
+for popular names.
+
+Entries live for NICE_METER_CACHE_TTL seconds, and at most
+NICE_METER_CACHE_SIZE names are kept. Names with no deeds are cached too.
+A write in this process puts the new total straight into the cache. It also
+sends a notification on NOTIFY_CHANNEL, and the listener in every other
+process drops its entry for that name. A read that races a write in another
+process can still cache the old total, but only until the TTL runs out.
+
+Call start_listener (or start_async_listener on an event loop) once the pool
+exists. Without a listener, entries still expire after the TTL.
+"""
+
+import asyncio
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+import psycopg
+
+import db
+
+NICE_METER_CACHE_SIZE = int(os.environ.get("NICE_METER_CACHE_SIZE", 10000))
+NICE_METER_CACHE_TTL = float(os.environ.get("NICE_METER_CACHE_TTL", 10))
+NOTIFY_CHANNEL = "naughty_nice"
+LISTEN_RETRY_INTERVAL = 5
+
+# Lets the listener skip the notifications this process sent itself
+PROCESS_ID = uuid.uuid4().hex
+# Returned by get when the name isn't cached, since None means the name has no deeds
+MISSING = object()
+
+class NiceMeterCache:
+    def __init__(self, size: int = NICE_METER_CACHE_SIZE, ttl: float = NICE_METER_CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries: OrderedDict[str, tuple[float, float | None]] = OrderedDict()
+        self.stats = { "hits": 0, "misses": 0, "invalidations": 0 }
+
+    def get(self, name: str):
+        """Return the cached total for a normalized name, None if it has no deeds, or MISSING."""
+        with self.lock:
+            entry = self.entries.get(name)
+            if entry is None or entry[0] < time.monotonic():
+                self.stats["misses"] += 1
+                return MISSING
+            self.entries.move_to_end(name)
+            self.stats["hits"] += 1
+            return entry[1]
+
+    def put(self, name: str, nice_meter: float | None):
+        with self.lock:
+            self.entries[name] = (time.monotonic() + self.ttl, nice_meter)
+            self.entries.move_to_end(name)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, name: str):
+        with self.lock:
+            if self.entries.pop(name, None) is not None:
+                self.stats["invalidations"] += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+cache = NiceMeterCache()
+
+_listener_lock = threading.Lock()
+_listener_thread: threading.Thread | None = None
+_listener_task: asyncio.Task | None = None
+
+def notification(name: str) -> str:
+    """The payload that tells the other processes a name has changed. "*" means every name."""
+    return f"{PROCESS_ID}:{name}"
+
+def _handle(payload: str):
+    process_id, _, name = payload.partition(":")
+    if process_id == PROCESS_ID:
+        return
+    if name == "*":
+        cache.clear()
+    else:
+        cache.invalidate(name)
+
+def _listen_forever():
+    while True:
+        try:
+            with psycopg.connect(db.get_pool().conninfo, autocommit=True) as conn:
+                conn.execute(f"LISTEN {NOTIFY_CHANNEL}")
+                # Changes made while we weren't listening were never announced to us
+                cache.clear()
+                for notify in conn.notifies():
+                    _handle(notify.payload)
+        except Exception as e:
+            print("Error: ", e)
+        time.sleep(LISTEN_RETRY_INTERVAL)
+
+async def _alisten_forever():
+    while True:
+        try:
+            async with await psycopg.AsyncConnection.connect(db.get_async_pool().conninfo, autocommit=True) as conn:
+                await conn.execute(f"LISTEN {NOTIFY_CHANNEL}")
+                cache.clear()
+                async for notify in conn.notifies():
+                    _handle(notify.payload)
+        except Exception as e:
+            print("Error: ", e)
+        await asyncio.sleep(LISTEN_RETRY_INTERVAL)
+
+def start_listener():
+    """Start listening for changes from other processes in a thread, if it isn't running already."""
+    global _listener_thread
+    with _listener_lock:
+        if _listener_thread is None:
+            _listener_thread = threading.Thread(target=_listen_forever, name="nice-meter-listener", daemon=True)
+            _listener_thread.start()
+
+def start_async_listener():
+    """Start listening for changes from other processes as a task on the running event loop."""
+    global _listener_task
+    if _listener_task is None or _listener_task.done():
+        _listener_task = asyncio.get_running_loop().create_task(_alisten_forever(), name="nice-meter-listener")
@@ -0,0 +1,112 @@
+"""
+Retention for the Postgres checkpointer tables.
+
+Every turn writes new checkpoints, and nothing in LangGraph ever deletes them.
+This job does three things, each in batches so it never holds long locks:
+
+1. Keeps only the newest RETENTION_KEEP_CHECKPOINTS checkpoints per thread.
+2. Deletes threads that have been idle for longer than RETENTION_THREAD_TTL.
+3. Vacuums checkpoint_writes and checkpoint_blobs rows that no remaining
+   checkpoint refers to. Threads with a checkpoint newer than
+   RETENTION_GRACE are skipped, since their blobs may be written before
+   the checkpoint that refers to them.
+
+Run it once with `python retention.py`, or as a background job with
+`python retention.py --every 3600`.
+"""
+
+import argparse
+import os
+import time
+
+import db
+
+RETENTION_KEEP_CHECKPOINTS = int(os.environ.get("RETENTION_KEEP_CHECKPOINTS", 5))
+RETENTION_THREAD_TTL = int(os.environ.get("RETENTION_THREAD_TTL", 30 * 24 * 3600))
+RETENTION_GRACE = int(os.environ.get("RETENTION_GRACE", 600))
+RETENTION_BATCH_SIZE = int(os.environ.get("RETENTION_BATCH_SIZE", 1000))
+
+# checkpoint_id is a time ordered uuid6, so the newest checkpoints sort last
+TRIM_CHECKPOINTS_SQL = """WITH doomed AS (
+        SELECT thread_id, checkpoint_ns, checkpoint_id FROM (
+            SELECT thread_id, checkpoint_ns, checkpoint_id,
+                row_number() OVER (PARTITION BY thread_id, checkpoint_ns ORDER BY checkpoint_id DESC) AS n
+            FROM checkpoints) ranked
+        WHERE n > %(keep)s
+        LIMIT %(batch)s)
+    DELETE FROM checkpoints c USING doomed
+    WHERE c.thread_id = doomed.thread_id AND c.checkpoint_ns = doomed.checkpoint_ns AND c.checkpoint_id = doomed.checkpoint_id
+    RETURNING pg_column_size(c.checkpoint) + pg_column_size(c.metadata) AS bytes"""
+
+EXPIRE_THREADS_SQL = """WITH idle AS (
+        SELECT thread_id FROM checkpoints
+        GROUP BY thread_id
+        HAVING max((checkpoint->>'ts')::timestamptz) < now() - make_interval(secs => %(ttl)s)
+        LIMIT %(batch)s)
+    DELETE FROM checkpoints c USING idle
+    WHERE c.thread_id = idle.thread_id
+    RETURNING pg_column_size(c.checkpoint) + pg_column_size(c.metadata) AS bytes"""
+
+RECENTLY_ACTIVE = """EXISTS (SELECT 1 FROM checkpoints c WHERE c.thread_id = t.thread_id
+        AND (c.checkpoint->>'ts')::timestamptz > now() - make_interval(secs => %(grace)s))"""
+
+VACUUM_WRITES_SQL = f"""DELETE FROM checkpoint_writes WHERE ctid IN (
+        SELECT t.ctid FROM checkpoint_writes t
+        WHERE NOT EXISTS (SELECT 1 FROM checkpoints c WHERE c.thread_id = t.thread_id
+            AND c.checkpoint_ns = t.checkpoint_ns AND c.checkpoint_id = t.checkpoint_id)
+        AND NOT {RECENTLY_ACTIVE}
+        LIMIT %(batch)s)
+    RETURNING pg_column_size(blob) AS bytes"""
+
+VACUUM_BLOBS_SQL = f"""DELETE FROM checkpoint_blobs WHERE ctid IN (
+        SELECT t.ctid FROM checkpoint_blobs t
+        WHERE NOT EXISTS (SELECT 1 FROM checkpoints c WHERE c.thread_id = t.thread_id
+            AND c.checkpoint_ns = t.checkpoint_ns AND c.checkpoint->'channel_versions'->>t.channel = t.version)
+        AND NOT {RECENTLY_ACTIVE}
+        LIMIT %(batch)s)
+    RETURNING coalesce(pg_column_size(blob), 0) AS bytes"""
+
+def _delete_in_batches(sql: str, params: dict) -> tuple[int, int]:
+    """Run a batched DELETE until it deletes nothing, and return (rows, bytes) deleted."""
+    rows = 0
+    freed = 0
+    while True:
+        with db.cursor() as cur:
+            cur.execute(sql, params)
+            deleted = cur.fetchall()
+        rows += len(deleted)
+        freed += sum(row["bytes"] or 0 for row in deleted)
+        if len(deleted) < params["batch"]:
+            return rows, freed
+
+def compact(keep: int = RETENTION_KEEP_CHECKPOINTS, ttl: int = RETENTION_THREAD_TTL,
+            grace: int = RETENTION_GRACE, batch: int = RETENTION_BATCH_SIZE) -> dict[str, tuple[int, int]]:
+    """Run all retention steps, and return the (rows, bytes) deleted by each."""
+    params = { "keep": keep, "ttl": ttl, "grace": grace, "batch": batch }
+    return {
+        "old checkpoints": _delete_in_batches(TRIM_CHECKPOINTS_SQL, params),
+        "idle threads": _delete_in_batches(EXPIRE_THREADS_SQL, params),
+        "orphaned writes": _delete_in_batches(VACUUM_WRITES_SQL, params),
+        "orphaned blobs": _delete_in_batches(VACUUM_BLOBS_SQL, params),
+    }
+
+def print_report(report: dict[str, tuple[int, int]]):
+    for step, (rows, freed) in report.items():
+        print(f"{step}: {rows} rows, {freed / 1024:.1f} kB")
+    print(f"total: {sum(freed for _, freed in report.values()) / 1024 / 1024:.2f} MB reclaimed")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Delete old checkpoints, idle threads and orphaned checkpoint data.")
+    parser.add_argument("--keep", type=int, default=RETENTION_KEEP_CHECKPOINTS, help="Checkpoints to keep per thread")
+    parser.add_argument("--ttl", type=int, default=RETENTION_THREAD_TTL, help="Seconds a thread can be idle before it is deleted")
+    parser.add_argument("--grace", type=int, default=RETENTION_GRACE, help="Seconds of activity that protect a thread from the orphan vacuum")
+    parser.add_argument("--batch", type=int, default=RETENTION_BATCH_SIZE, help="Rows deleted per statement")
+    parser.add_argument("--every", type=int, help="Keep running, and compact every this many seconds")
+    args = parser.parse_args()
+
+    db.get_checkpointer(os.environ.get("DB_URI") or "")
+    while True:
+        print_report(compact(args.keep, args.ttl, args.grace, args.batch))
+        if args.every is None:
+            break
+        time.sleep(args.every)
@@ -0,0 +1,134 @@
+"""
+Cache of nice scores for actions, so repeated deeds skip the LLM grader.
+
+Actions are normalized before lookup, so "I vacuumed." and "i  vacuumed" share
+an entry. The in-memory tier is an LRU per process. The optional Postgres tier
+(SCORE_CACHE_PERSISTENT=1) is shared by all replicas, and entries in it expire
+after SCORE_CACHE_TTL seconds.
+"""
+
+import os
+import re
+import threading
+from collections import OrderedDict
+
+import db
+
+SCORE_CACHE_SIZE = int(os.environ.get("SCORE_CACHE_SIZE", 10000))
+SCORE_CACHE_TTL = int(os.environ.get("SCORE_CACHE_TTL", 7 * 24 * 3600))
+SCORE_CACHE_PERSISTENT = os.environ.get("SCORE_CACHE_PERSISTENT", "0") == "1"
+# Expired rows in the Postgres tier are deleted once every this many writes
+SCORE_CACHE_EVICT_EVERY = 1000
+
+SELECT_SQL = "SELECT nice_score FROM score_cache WHERE key=%s AND created_at > now() - make_interval(secs => %s)"
+UPSERT_SQL = "INSERT INTO score_cache (key, nice_score) VALUES (%s, %s) ON CONFLICT (key) DO UPDATE SET nice_score = EXCLUDED.nice_score, created_at = now()"
+EVICT_SQL = "DELETE FROM score_cache WHERE created_at <= now() - make_interval(secs => %s)"
+
+def normalize_action(action: str) -> str:
+    action = re.sub(r"\s+", " ", action.strip().lower())
+    return action.rstrip(" .!?")
+
+class ScoreCache:
+    def __init__(self, namespace: str, size: int = SCORE_CACHE_SIZE, ttl: int = SCORE_CACHE_TTL,
+                 persistent: bool = SCORE_CACHE_PERSISTENT):
+        # The namespace keeps scores from different grading prompts (languages) apart
+        self.namespace = namespace
+        self.size = size
+        self.ttl = ttl
+        self.persistent = persistent
+        self.lock = threading.Lock()
+        self.entries: OrderedDict[str, float] = OrderedDict()
+        self.stats = { "memory_hits": 0, "db_hits": 0, "misses": 0 }
+        self.writes = 0
+
+    def key(self, action: str) -> str:
+        return f"{self.namespace}:{normalize_action(action)}"
+
+    def get(self, action: str) -> float | None:
+        key = self.key(action)
+        nice_score = self._lookup(key)
+        if nice_score is None and self.persistent:
+            try:
+                with db.cursor() as cur:
+                    cur.execute(SELECT_SQL, (key, self.ttl))
+                    nice_score = self._found_in_db(key, cur.fetchone())
+            except Exception as e:
+                print("Error: ", e)
+        return self._count(nice_score)
+
+    def put(self, action: str, nice_score: float):
+        key = self.key(action)
+        self._remember(key, nice_score)
+        if self.persistent:
+            try:
+                with db.cursor() as cur:
+                    cur.execute(UPSERT_SQL, (key, nice_score))
+                if self._should_evict():
+                    print("Evicted expired scores: ", self.evict_expired())
+            except Exception as e:
+                print("Error: ", e)
+
+    def evict_expired(self) -> int:
+        """Delete expired rows from the Postgres tier, and return how many were removed."""
+        with db.cursor() as cur:
+            cur.execute(EVICT_SQL, (self.ttl,))
+            return cur.rowcount
+
+    async def aget(self, action: str) -> float | None:
+        key = self.key(action)
+        nice_score = self._lookup(key)
+        if nice_score is None and self.persistent:
+            try:
+                async with db.async_cursor() as cur:
+                    await cur.execute(SELECT_SQL, (key, self.ttl))
+                    nice_score = self._found_in_db(key, await cur.fetchone())
+            except Exception as e:
+                print("Error: ", e)
+        return self._count(nice_score)
+
+    async def aput(self, action: str, nice_score: float):
+        key = self.key(action)
+        self._remember(key, nice_score)
+        if self.persistent:
+            try:
+                async with db.async_cursor() as cur:
+                    await cur.execute(UPSERT_SQL, (key, nice_score))
+                    if self._should_evict():
+                        await cur.execute(EVICT_SQL, (self.ttl,))
+                        print("Evicted expired scores: ", cur.rowcount)
+            except Exception as e:
+                print("Error: ", e)
+
+    def _lookup(self, key: str) -> float | None:
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.stats["memory_hits"] += 1
+                return self.entries[key]
+        return None
+
+    def _found_in_db(self, key: str, row: dict | None) -> float | None:
+        if row is None:
+            return None
+        self._remember(key, row["nice_score"])
+        with self.lock:
+            self.stats["db_hits"] += 1
+        return row["nice_score"]
+
+    def _count(self, nice_score: float | None) -> float | None:
+        if nice_score is None:
+            with self.lock:
+                self.stats["misses"] += 1
+        return nice_score
+
+    def _should_evict(self) -> bool:
+        with self.lock:
+            self.writes += 1
+            return self.writes % SCORE_CACHE_EVICT_EVERY == 0
+
+    def _remember(self, key: str, nice_score: float):
+        with self.lock:
+            self.entries[key] = nice_score
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
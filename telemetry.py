@@ -0,0 +1,339 @@
+"""
+Metrics and tracing for the Santa graphs.
+
+Everything is measured in-process and exposed in the Prometheus text format,
+either from `render()` or from a small HTTP server on METRICS_PORT. What is
+measured, and where it is hooked in:
+
+- graph nodes, tools and LLM calls, including token usage, through
+  TelemetryCallbackHandler, passed in the graph config
+- every SQL statement, through the TimedCursor cursor factory on the pools
+- checkpoint bytes written and read, through the measured savers in db.py
+- LLM queue depth, waits, retries and coalesced calls, from dispatcher.py
+
+Each turn runs inside `trace()`. A TRACE_SAMPLE_RATE share of turns also write
+their spans as JSON lines to TRACE_LOG (a file path, or "-" for stderr).
+"""
+
+import contextvars
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any
+
+import psycopg
+from langchain_core.callbacks import BaseCallbackHandler
+
+TRACE_SAMPLE_RATE = float(os.environ.get("TRACE_SAMPLE_RATE", 0.0))
+TRACE_LOG = os.environ.get("TRACE_LOG")
+METRICS_PORT = os.environ.get("METRICS_PORT")
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+class Metric:
+    def __init__(self, name: str, help: str, kind: str):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    @staticmethod
+    def labels(key: tuple, extra: str = "") -> str:
+        parts = [f'{label}="{value}"' for label, value in key] + ([extra] if extra else [])
+        return "{" + ",".join(parts) + "}" if parts else ""
+
+class Counter(Metric):
+    def __init__(self, name: str, help: str):
+        super().__init__(name, help, "counter")
+        self.values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        with self.lock:
+            return self.values.get(tuple(sorted(labels.items())), 0)
+
+    def samples(self) -> list[str]:
+        with self.lock:
+            return [f"{self.name}{self.labels(key)} {value}" for key, value in self.values.items()]
+
+class Gauge(Counter):
+    def __init__(self, name: str, help: str):
+        super().__init__(name, help)
+        self.kind = "gauge"
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+class Histogram(Metric):
+    def __init__(self, name: str, help: str, buckets: tuple = BUCKETS):
+        super().__init__(name, help, "histogram")
+        self.buckets = buckets
+        self.values: dict[tuple, list] = {}
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            counts = self.values.setdefault(key, [0] * len(self.buckets) + [0, 0.0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-2] += 1
+            counts[-1] += value
+
+    def samples(self) -> list[str]:
+        lines = []
+        with self.lock:
+            for key, counts in self.values.items():
+                for bound, count in zip(self.buckets, counts):
+                    le = 'le="%s"' % bound
+                    lines.append(f"{self.name}_bucket{self.labels(key, le)} {count}")
+                le = 'le="+Inf"'
+                lines.append(f"{self.name}_bucket{self.labels(key, le)} {counts[-2]}")
+                lines.append(f"{self.name}_count{self.labels(key)} {counts[-2]}")
+                lines.append(f"{self.name}_sum{self.labels(key)} {counts[-1]}")
+        return lines
+
+REGISTRY: list[Metric] = []
+
+span_seconds = Histogram("santa_span_seconds", "Duration of turns, graph nodes, tools and LLM calls")
+span_errors = Counter("santa_span_errors_total", "Turns, graph nodes, tools and LLM calls that raised")
+llm_tokens = Counter("santa_llm_tokens_total", "Tokens used by LLM calls")
+sql_seconds = Histogram("santa_sql_seconds", "Duration of SQL statements")
+checkpoint_bytes = Counter("santa_checkpoint_bytes_total", "Serialized checkpoint bytes written and read")
+llm_queue_depth = Gauge("santa_llm_queue_depth", "LLM calls waiting for a concurrency slot")
+llm_in_flight = Gauge("santa_llm_in_flight", "LLM calls being sent")
+llm_wait_seconds = Histogram("santa_llm_wait_seconds", "Time LLM calls waited for a concurrency slot and the rate limit")
+llm_retries = Counter("santa_llm_retries_total", "LLM calls retried after a rate limit or server error")
+llm_coalesced = Counter("santa_llm_coalesced_total", "LLM calls answered by an identical call already in flight")
+
+def render() -> str:
+    lines = []
+    for metric in REGISTRY:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.samples())
+    return "\n".join(lines) + "\n"
+
+### Tracing ###
+
+_trace_id: contextvars.ContextVar[str | None] = contextvars.ContextVar("trace_id", default=None)
+_sampled: contextvars.ContextVar[bool] = contextvars.ContextVar("sampled", default=False)
+_log_lock = threading.Lock()
+
+def _log_span(kind: str, name: str, started: float, seconds: float, span_id: Any = None, parent_id: Any = None, **attrs):
+    if not (_sampled.get() and TRACE_LOG):
+        return
+    line = json.dumps({
+        "trace_id": _trace_id.get(),
+        "span_id": str(span_id or uuid.uuid4()),
+        "parent_id": str(parent_id) if parent_id else None,
+        "kind": kind,
+        "name": name,
+        "start": started,
+        "duration_ms": round(seconds * 1000, 3),
+        **attrs,
+    }, default=str)
+    with _log_lock:
+        if TRACE_LOG == "-":
+            print(line, file=sys.stderr, flush=True)
+        else:
+            with open(TRACE_LOG, "a") as f:
+                f.write(line + "\n")
+
+def record(kind: str, name: str, started: float, seconds: float, error: bool = False, **attrs):
+    """Record a finished span, `started` being wall clock time and `seconds` its duration."""
+    span_seconds.observe(seconds, kind=kind, name=name)
+    if error:
+        span_errors.inc(kind=kind, name=name)
+    _log_span(kind, name, started, seconds, error=error, **attrs)
+
+@contextmanager
+def span(kind: str, name: str, **attrs):
+    started = time.time()
+    start = time.perf_counter()
+    error = False
+    try:
+        yield
+    except BaseException:
+        error = True
+        raise
+    finally:
+        record(kind, name, started, time.perf_counter() - start, error=error, **attrs)
+
+@contextmanager
+def trace(name: str, **attrs):
+    """Run one turn as a trace. Decides whether the spans inside it are logged."""
+    trace_token = _trace_id.set(uuid.uuid4().hex)
+    sampled_token = _sampled.set(random.random() < TRACE_SAMPLE_RATE)
+    try:
+        with span("turn", name, **attrs):
+            yield
+    finally:
+        _sampled.reset(sampled_token)
+        _trace_id.reset(trace_token)
+
+class TelemetryCallbackHandler(BaseCallbackHandler):
+    """Times graph nodes, tools and LLM calls, and counts LLM tokens."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.runs: dict[Any, tuple] = {}
+
+    def _start(self, run_id, kind: str, name: str):
+        with self.lock:
+            self.runs[run_id] = (kind, name, time.time(), time.perf_counter())
+
+    def _end(self, run_id, parent_run_id=None, error: bool = False, **attrs):
+        with self.lock:
+            run = self.runs.pop(run_id, None)
+        if run is not None:
+            kind, name, started, start = run
+            record(kind, name, started, time.perf_counter() - start, error=error,
+                   span_id=run_id, parent_id=parent_run_id, **attrs)
+
+    def on_chain_start(self, serialized, inputs, *, run_id, parent_run_id=None, metadata=None, **kwargs):
+        # Only the run of the node itself, not the runnables inside it, which can have
+        # the node's name too, and not langgraph's own __start__ node
+        node = (metadata or {}).get("langgraph_node")
+        if node is None or kwargs.get("name") != node or node.startswith("__"):
+            return
+        with self.lock:
+            parent = self.runs.get(parent_run_id)
+        if parent is None or parent[:2] != ("node", node):
+            self._start(run_id, "node", node)
+
+    def on_chain_end(self, outputs, *, run_id, parent_run_id=None, **kwargs):
+        self._end(run_id, parent_run_id)
+
+    def on_chain_error(self, error, *, run_id, parent_run_id=None, **kwargs):
+        self._end(run_id, parent_run_id, error=True)
+
+    def on_tool_start(self, serialized, input_str, *, run_id, parent_run_id=None, **kwargs):
+        self._start(run_id, "tool", (serialized or {}).get("name") or kwargs.get("name") or "tool")
+
+    def on_tool_end(self, output, *, run_id, parent_run_id=None, **kwargs):
+        self._end(run_id, parent_run_id)
+
+    def on_tool_error(self, error, *, run_id, parent_run_id=None, **kwargs):
+        self._end(run_id, parent_run_id, error=True)
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, parent_run_id=None, metadata=None, **kwargs):
+        self._start(run_id, "llm", (metadata or {}).get("ls_model_name") or "llm")
+
+    def on_llm_start(self, serialized, prompts, *, run_id, parent_run_id=None, metadata=None, **kwargs):
+        self._start(run_id, "llm", (metadata or {}).get("ls_model_name") or "llm")
+
+    def on_llm_end(self, response, *, run_id, parent_run_id=None, **kwargs):
+        with self.lock:
+            model = self.runs.get(run_id, ("llm", "llm"))[1]
+        input_tokens, output_tokens = _token_usage(response)
+        llm_tokens.inc(input_tokens, model=model, type="input")
+        llm_tokens.inc(output_tokens, model=model, type="output")
+        self._end(run_id, parent_run_id, input_tokens=input_tokens, output_tokens=output_tokens)
+
+    def on_llm_error(self, error, *, run_id, parent_run_id=None, **kwargs):
+        self._end(run_id, parent_run_id, error=True)
+
+def _token_usage(response) -> tuple[int, int]:
+    usage = (response.llm_output or {}).get("token_usage") or {}
+    if usage:
+        return usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0)
+    # Streamed responses only have the usage on the message
+    for generations in response.generations:
+        for generation in generations:
+            usage = getattr(getattr(generation, "message", None), "usage_metadata", None)
+            if usage:
+                return usage.get("input_tokens", 0), usage.get("output_tokens", 0)
+    return 0, 0
+
+callback_handler = TelemetryCallbackHandler()
+
+### SQL ###
+
+STATEMENT_PATTERN = re.compile(r"^\s*(?:WITH\s+\w+\s+AS\s*\(\s*)?(SELECT|INSERT INTO|UPDATE|DELETE FROM|CREATE \w+|ALTER TABLE|LOCK TABLE)\s+(?:IF NOT EXISTS\s+)?([\w.]+)?", re.IGNORECASE)
+
+def statement_label(query) -> str:
+    """A short, low cardinality label for a query, like "INSERT INTO deed_ledger"."""
+    text = query if isinstance(query, str) else str(getattr(query, "_obj", query))
+    match = STATEMENT_PATTERN.match(text)
+    if match is None:
+        return "other"
+    verb, target = match.groups()
+    return f"{verb.upper()} {target}" if target and verb.upper() != "SELECT" else verb.upper()
+
+class TimedCursor(psycopg.Cursor):
+    def execute(self, query, params=None, **kwargs):
+        started = time.time()
+        start = time.perf_counter()
+        try:
+            return super().execute(query, params, **kwargs)
+        finally:
+            _record_sql(query, started, time.perf_counter() - start)
+
+    def executemany(self, query, params_seq, **kwargs):
+        started = time.time()
+        start = time.perf_counter()
+        try:
+            return super().executemany(query, params_seq, **kwargs)
+        finally:
+            _record_sql(query, started, time.perf_counter() - start)
+
+class AsyncTimedCursor(psycopg.AsyncCursor):
+    async def execute(self, query, params=None, **kwargs):
+        started = time.time()
+        start = time.perf_counter()
+        try:
+            return await super().execute(query, params, **kwargs)
+        finally:
+            _record_sql(query, started, time.perf_counter() - start)
+
+    async def executemany(self, query, params_seq, **kwargs):
+        started = time.time()
+        start = time.perf_counter()
+        try:
+            return await super().executemany(query, params_seq, **kwargs)
+        finally:
+            _record_sql(query, started, time.perf_counter() - start)
+
+def _record_sql(query, started: float, seconds: float):
+    label = statement_label(query)
+    sql_seconds.observe(seconds, statement=label)
+    _log_span("sql", label, started, seconds)
+
+### Exposition ###
+
+_server: ThreadingHTTPServer | None = None
+_server_lock = threading.Lock()
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_metrics_server(port: str | int | None = METRICS_PORT):
+    """Serve the metrics on http://0.0.0.0:<port>/, once per process. Does nothing without a port."""
+    global _server
+    if not port:
+        return
+    with _server_lock:
+        if _server is None:
+            _server = ThreadingHTTPServer(("0.0.0.0", int(port)), _MetricsHandler)
+            threading.Thread(target=_server.serve_forever, name="metrics", daemon=True).start()